@@ -0,0 +1,614 @@
+"""
+Benchmarks of the optimized code paths against the original implementations.
+Every benchmark also checks that both implementations give the same result.
+
+python benchmark.py bvh_load ./datasets/Mixamo/std_bvhs/Aj.bvh --scale 20
+python benchmark.py euler_to_quaternion --frames 20000
+python benchmark.py attention --batch_size 64
+python benchmark.py gan_step --batch_size 16
+python benchmark.py fk --character Aj --batch_size 64
+python benchmark.py rotation --size 500000
+python benchmark.py contact_targets --clips 64 --frames 1024
+python benchmark.py skeleton_topology --joints 64
+"""
+
+import argparse
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+import torch
+
+sys.path.append("./utils")
+
+
+def timeit(fn, repeat):
+    """ best wall time of repeat runs and the result of the last run """
+    best = float('inf')
+    for _ in range(repeat):
+        begin = time.perf_counter()
+        result = fn()
+        best = min(best, time.perf_counter() - begin)
+    return best, result
+
+
+def report(name, time_ref, time_new):
+    print('{}: original {:.4f}s, new {:.4f}s, speedup x{:.1f}'.format(name, time_ref, time_new, time_ref / time_new))
+
+
+""" BVH loading """
+
+
+def make_long_bvh(path, scale):
+    """ copy of a bvh with its motion rows repeated scale times """
+    with open(path, 'r') as f:
+        lines = f.readlines()
+    frame_line = [i for i, line in enumerate(lines) if line.strip().startswith('Frame Time')][0]
+    rows = [line for line in lines[frame_line + 1:] if line.strip()]
+
+    file = tempfile.NamedTemporaryFile('w', suffix='.bvh', delete=False)
+    for line in lines[:frame_line + 1]:
+        if line.strip().startswith('Frames:'):
+            line = 'Frames: {}\n'.format(len(rows) * scale)
+        file.write(line)
+    for _ in range(scale):
+        file.writelines(rows)
+    file.close()
+    return file.name
+
+
+def check_same_animation(res_ref, res_new):
+    anim_ref, names_ref, frametime_ref = res_ref
+    anim_new, names_new, frametime_new = res_new
+    assert names_ref == names_new
+    assert frametime_ref == frametime_new
+    assert np.array_equal(anim_ref.rotations, anim_new.rotations)
+    assert np.array_equal(anim_ref.positions, anim_new.positions)
+    assert np.array_equal(anim_ref.offsets, anim_new.offsets)
+    assert np.array_equal(anim_ref.parents, anim_new.parents)
+    assert np.array_equal(anim_ref.orients.qs, anim_new.orients.qs)
+
+
+def bench_bvh_load(args):
+    import BVH_mod
+    import BVH_fast
+
+    for path in args.files:
+        long_path = make_long_bvh(path, args.scale)
+        try:
+            time_ref, res_ref = timeit(lambda: BVH_mod.load(long_path), args.repeat)
+            time_new, res_new = timeit(lambda: BVH_fast.load(long_path), args.repeat)
+            check_same_animation(res_ref, res_new)
+            report('{} ({} frames)'.format(os.path.basename(path), res_new[0].shape[0]), time_ref, time_new)
+        finally:
+            os.remove(long_path)
+
+
+""" Euler -> quaternion conversion """
+
+
+def bench_euler_to_quaternion(args):
+    from Quaternions import Quaternions
+    from models.rotation import euler_to_quaternion
+
+    rng = np.random.RandomState(0)
+    euler = rng.uniform(-180, 180, (args.frames, args.joints, 3)).astype(np.float32)
+    step, window = 64, 128
+    starts = range(0, args.frames - window + 1, step)
+
+    def per_window():
+        return [Quaternions.from_euler(np.radians(euler[s:s + window])).qs for s in starts]
+
+    def once():
+        return Quaternions.from_euler(np.radians(euler)).qs
+
+    time_ref, res_ref = timeit(per_window, args.repeat)
+    time_new, res_new = timeit(once, args.repeat)
+    for s, q in zip(starts, res_ref):
+        assert np.array_equal(q, res_new[s:s + window])
+    report('numpy, per window vs once ({} frames)'.format(args.frames), time_ref, time_new)
+
+    devices = ['cpu'] + (['cuda'] if torch.cuda.is_available() else [])
+    for device in devices:
+        euler_tensor = torch.tensor(np.radians(euler), device=device)
+
+        def on_device():
+            q = euler_to_quaternion(euler_tensor)
+            if device == 'cuda': torch.cuda.synchronize()
+            return q
+
+        time_dev, res_dev = timeit(on_device, args.repeat)
+        assert np.allclose(res_dev.cpu().numpy(), res_new, atol=1e-6)
+        report('numpy once vs torch {}'.format(device), time_new, time_dev)
+
+
+""" Attention backends """
+
+
+def get_model_args(argv):
+    import option_parser
+    args = option_parser.get_parser().parse_args(argv)
+    args.input_size = args.output_size = args.d_hidn
+    return args
+
+
+def bench_attention(args):
+    import copy
+    from model import ScaledDotProductAttention, Discriminator
+
+    device = torch.device(args.device)
+    model_args = get_model_args([])
+    torch.manual_seed(0)
+
+    """ attention alone: explicit softmax vs fused kernel """
+    shape = (args.batch_size, model_args.n_head, model_args.window_size, model_args.d_head)
+    Q, K, V = [torch.randn(shape, device=device) for _ in range(3)]
+    explicit = ScaledDotProductAttention(model_args)
+    explicit.backend = 'explicit'
+    fused = ScaledDotProductAttention(model_args)
+
+    def run(attention):
+        def fn():
+            with torch.no_grad():
+                context, _ = attention(Q, K, V, need_weights=False)
+            if device.type == 'cuda': torch.cuda.synchronize()
+            return context
+        return fn
+
+    time_ref, res_ref = timeit(run(explicit), args.repeat)
+    time_new, res_new = timeit(run(fused), args.repeat)
+    assert torch.allclose(res_ref, res_new, atol=1e-5), (res_ref - res_new).abs().max()
+    report('attention {}'.format(tuple(shape)), time_ref, time_new)
+
+    """ discriminator forward (attention maps are not needed there) """
+    offsets = [None, None]
+    model_ref = Discriminator(get_model_args(['--attention_backend', 'explicit']), offsets).to(device)
+    model_new = copy.deepcopy(model_ref)
+    for module in model_new.modules():
+        if isinstance(module, ScaledDotProductAttention):
+            module.backend = 'fused'
+    motions = torch.randn(args.batch_size, model_args.d_hidn, model_args.window_size, device=device)
+
+    def forward(model):
+        def fn():
+            with torch.no_grad():
+                output = model(0, 0, motions, motions)
+            if device.type == 'cuda': torch.cuda.synchronize()
+            return output
+        return fn
+
+    time_ref, res_ref = timeit(forward(model_ref), args.repeat)
+    time_new, res_new = timeit(forward(model_new), args.repeat)
+    assert torch.allclose(res_ref, res_new, atol=1e-5), (res_ref - res_new).abs().max()
+    report('Discriminator forward', time_ref, time_new)
+
+
+""" GAN training step """
+
+
+def legacy_gan_step(args, modelG, modelD, optimizerG, optimizerD, gan_criterion, enc_inputs, gt_motions):
+    """ the step train_epoch used to run: three discriminator passes, one backward for both models """
+    from models.utils import mse_per_sample
+    optimizerG.zero_grad()
+    optimizerD.zero_grad()
+    output_motions = modelG(0, 0, enc_inputs, gt_motions)[0]
+    sum_loss = mse_per_sample(output_motions, gt_motions).sum()
+    sum_loss += gan_criterion.per_sample(modelD(0, 0, enc_inputs, enc_inputs), True).sum()
+    sum_loss += gan_criterion.per_sample(modelD(0, 0, output_motions.detach(), output_motions.detach()), False).sum()
+    sum_loss += gan_criterion.per_sample(modelD(0, 0, output_motions, output_motions), True).sum()
+    sum_loss.backward()
+    optimizerG.step()
+    optimizerD.step()
+
+
+def new_gan_step(args, modelG, modelD, optimizerG, optimizerD, gan_criterion, enc_inputs, gt_motions):
+    from train import train_step
+    from models.utils import LossAggregator, make_grad_scaler
+    train_step(args, modelG, modelD, optimizerG, optimizerD, make_grad_scaler(args), gan_criterion,
+               0, enc_inputs, gt_motions, LossAggregator([]))
+
+
+class SavedTensorMeter:
+    """ peak bytes of the tensors autograd keeps alive for backward (activation memory, on any device) """
+    def __init__(self):
+        self.live = 0
+        self.peak = 0
+
+    class Saved:
+        def __init__(self, meter, tensor):
+            self.meter = meter
+            self.tensor = tensor
+            self.bytes = tensor.numel() * tensor.element_size()
+            meter.live += self.bytes
+            meter.peak = max(meter.peak, meter.live)
+
+        def __del__(self):
+            self.meter.live -= self.bytes
+
+    def __call__(self, fn):
+        with torch.autograd.graph.saved_tensors_hooks(lambda tensor: self.Saved(self, tensor), lambda saved: saved.tensor):
+            fn()
+        return self.peak
+
+
+def bench_gan_step(args):
+    import copy
+    from model import MotionGenerator, Discriminator
+    from models.utils import GAN_loss
+
+    device = torch.device(args.device)
+    offsets = [None, None]
+    model_args = get_model_args([])
+    motions = torch.randn(args.batch_size, model_args.d_hidn, model_args.window_size, device=device)
+
+    def make(argv):
+        model_args = get_model_args(['--cuda_device', args.device] + argv)
+        torch.manual_seed(0)
+        modelG = MotionGenerator(model_args, offsets).to(device)
+        modelD = Discriminator(model_args, offsets).to(device)
+        optimizerG = torch.optim.Adam(modelG.parameters(), lr=model_args.learning_rate)
+        optimizerD = torch.optim.Adam(modelD.parameters(), lr=model_args.learning_rate)
+        gan_criterion = GAN_loss(model_args.gan_mode).to(device)
+        return model_args, modelG, modelD, optimizerG, optimizerD, gan_criterion
+
+    def run(step, setup):
+        def fn():
+            step(*setup, motions, motions)
+            if device.type == 'cuda': torch.cuda.synchronize()
+        return fn
+
+    def peak_memory(fn):
+        if device.type != 'cuda':
+            return 'n/a'
+        torch.cuda.reset_peak_memory_stats(device)
+        fn()
+        return '{:.1f}MB'.format(torch.cuda.max_memory_allocated(device) / 2 ** 20)
+
+    def check_same_gradients(model_ref, model_new):
+        for p_ref, p_new in zip(model_ref.parameters(), model_new.parameters()):
+            if p_ref.grad is not None:
+                assert torch.allclose(p_ref.grad, p_new.grad, rtol=1e-4, atol=1e-6), (p_ref.grad - p_new.grad).abs().max()
+
+    """ same generator gradients as the legacy step (the discriminator no longer gets the G loss gradient) """
+    setup_ref, setup_new = make([]), make([])
+    run(legacy_gan_step, setup_ref)()
+    run(new_gan_step, setup_new)()
+    check_same_gradients(setup_ref[1], setup_new[1])
+
+    """ gradient accumulation: same gradients of both models as the whole batch """
+    micro_batch = ['--micro_batch_size', str(max(1, args.batch_size // 4))]
+    setup_ref, setup_new = make([]), make(micro_batch)
+    run(new_gan_step, setup_ref)()
+    run(new_gan_step, setup_new)()
+    check_same_gradients(setup_ref[1], setup_new[1])
+    check_same_gradients(setup_ref[2], setup_new[2])
+
+    steps = [('legacy (3 D passes)', legacy_gan_step, []),
+             ('shared', new_gan_step, ['--gan_update', 'shared']),
+             ('alternating', new_gan_step, ['--gan_update', 'alternating']),
+             ('shared, light D', new_gan_step, ['--gan_update', 'shared', '--light_discriminator', '1']),
+             ('shared, micro-batches of {}'.format(micro_batch[1]), new_gan_step, micro_batch)]
+    time_ref = None
+    for name, step, argv in steps:
+        fn = run(step, make(argv))
+        fn()  # warm up
+        elapsed, _ = timeit(fn, args.repeat)
+        saved = SavedTensorMeter()(fn) / 2 ** 20
+        peak = peak_memory(fn)
+        time_ref = time_ref or elapsed
+        print('{}: {:.4f}s (x{:.2f}), peak saved activations {:.1f}MB, peak memory {}'.format(
+            name, elapsed, time_ref / elapsed, saved, peak))
+
+
+""" Forward kinematics """
+
+
+def bench_fk(args):
+    from types import SimpleNamespace
+    from datasets.skeleton_registry import get_skeleton
+    from models.Kinematics import ForwardKinematics
+
+    device = torch.device(args.device)
+    edges = get_skeleton(args.character).edges
+    n_joint = len(edges) + 1
+    torch.manual_seed(0)
+    rotation = torch.randn(args.batch_size, n_joint, 4, args.frames, device=device)
+    position = torch.randn(args.batch_size, 3, args.frames, device=device)
+    offset = torch.randn(args.batch_size, n_joint, 3, device=device)
+
+    def run(backend):
+        fk = ForwardKinematics(SimpleNamespace(rotation='quaternion', fk_backend=backend), edges)
+
+        def fn():
+            with torch.no_grad():
+                result = fk.forward(rotation, position, offset, quater=True, world=True)
+            if device.type == 'cuda': torch.cuda.synchronize()
+            return result
+        fn()  # warm up (script / compile)
+        return fn
+
+    time_ref, res_ref = timeit(run('loop'), args.repeat)
+    for backend in ('levels', 'script', 'compile'):
+        time_new, res_new = timeit(run(backend), args.repeat)
+        assert torch.allclose(res_ref, res_new, atol=1e-4), (res_ref - res_new).abs().max()
+        report('fk {} ({} joints, {} x {} frames)'.format(backend, n_joint, args.batch_size, args.frames), time_ref, time_new)
+
+
+""" Rotation conversions """
+
+
+def legacy_transform_from_axis(euler, axis):
+    """ the per-element fill ForwardKinematics used before models/rotation.py """
+    transform = torch.empty(euler.shape + (3, 3), device=euler.device)
+    cos = torch.cos(euler)
+    sin = torch.sin(euler)
+    cord = ord(axis) - ord('x')
+    transform[..., cord, :] = transform[..., :, cord] = 0
+    transform[..., cord, cord] = 1
+    if axis == 'x':
+        transform[..., 1, 1] = transform[..., 2, 2] = cos
+        transform[..., 1, 2] = -sin
+        transform[..., 2, 1] = sin
+    if axis == 'y':
+        transform[..., 0, 0] = transform[..., 2, 2] = cos
+        transform[..., 0, 2] = sin
+        transform[..., 2, 0] = -sin
+    if axis == 'z':
+        transform[..., 0, 0] = transform[..., 1, 1] = cos
+        transform[..., 0, 1] = -sin
+        transform[..., 1, 0] = sin
+    return transform
+
+
+def legacy_euler_to_matrix(euler, order='xyz'):
+    transform = torch.matmul(legacy_transform_from_axis(euler[..., 1], order[1]), legacy_transform_from_axis(euler[..., 2], order[2]))
+    return torch.matmul(legacy_transform_from_axis(euler[..., 0], order[0]), transform)
+
+
+def legacy_quaternion_to_matrix(quater):
+    qw, qx, qy, qz = quater[..., 0], quater[..., 1], quater[..., 2], quater[..., 3]
+    x2, y2, z2 = qx + qx, qy + qy, qz + qz
+    xx, yy, wx, xy, yz = qx * x2, qy * y2, qw * x2, qx * y2, qy * z2
+    wy, xz, zz, wz = qw * y2, qx * z2, qz * z2, qw * z2
+    m = torch.empty(quater.shape[:-1] + (3, 3), device=quater.device)
+    m[..., 0, 0] = 1.0 - (yy + zz)
+    m[..., 0, 1] = xy - wz
+    m[..., 0, 2] = xz + wy
+    m[..., 1, 0] = xy + wz
+    m[..., 1, 1] = 1.0 - (xx + zz)
+    m[..., 1, 2] = yz - wx
+    m[..., 2, 0] = xz - wy
+    m[..., 2, 1] = yz + wx
+    m[..., 2, 2] = 1.0 - (xx + yy)
+    return m
+
+
+def bench_rotation(args):
+    from models import rotation
+
+    device = torch.device(args.device)
+    torch.manual_seed(0)
+    euler = torch.randn(args.size, 3, device=device)
+    quater = torch.nn.functional.normalize(torch.randn(args.size, 4, device=device), dim=-1)
+
+    def forward_backward(fn, data):
+        def run():
+            data_grad = data.clone().requires_grad_(True)
+            result = fn(data_grad)
+            result.sum().backward()
+            if device.type == 'cuda': torch.cuda.synchronize()
+            return result.detach(), data_grad.grad
+        return run
+
+    """ same matrices and gradients as the old per-element fill """
+    for name, fn_ref, fn_new, data in (('euler_to_matrix', legacy_euler_to_matrix, rotation.euler_to_matrix, euler),
+                                       ('quaternion_to_matrix', legacy_quaternion_to_matrix, rotation.quaternion_to_matrix, quater)):
+        time_ref, res_ref = timeit(forward_backward(fn_ref, data), args.repeat)
+        time_new, res_new = timeit(forward_backward(fn_new, data), args.repeat)
+        for tensor_ref, tensor_new in zip(res_ref, res_new):
+            assert torch.allclose(tensor_ref, tensor_new, atol=1e-5), (tensor_ref - tensor_new).abs().max()
+        report('{} forward + backward ({})'.format(name, args.size), time_ref, time_new)
+
+    """ new representations (no previous implementation) """
+    for name, fn, data in (('axis_angle_to_matrix', rotation.axis_angle_to_matrix, euler),
+                           ('rotation_6d_to_matrix', rotation.rotation_6d_to_matrix, torch.cat((euler, euler.flip(-1)), dim=-1))):
+        elapsed, _ = timeit(forward_backward(fn, data), args.repeat)
+        print('{} forward + backward ({}): {:.4f}s'.format(name, args.size, elapsed))
+
+
+""" Foot contact targets """
+
+
+def legacy_contact_targets(glb, contact, fid):
+    """ the original frame by frame loop of get_contact_targets: glb (T, J, 3), contact (T, n_foot) """
+    from models.tmp.IK import L, alpha, lerp
+
+    glb = glb.copy()
+    T = glb.shape[0]
+
+    for i, fidx in enumerate(fid):  # fidx: index of the foot joint
+        fixed = contact[:, i]  # [T]
+        s = 0
+        while s < T:
+            while s < T and fixed[s] == 0:
+                s += 1
+            if s >= T:
+                break
+            t = s
+            avg = glb[t, fidx].copy()
+            while t + 1 < T and fixed[t + 1] == 1:
+                t += 1
+                avg += glb[t, fidx].copy()
+            avg /= (t - s + 1)
+
+            for j in range(s, t + 1):
+                glb[j, fidx] = avg.copy()
+            s = t + 1
+
+        for s in range(T):
+            if fixed[s] == 1:
+                continue
+            l, r = None, None
+            consl, consr = False, False
+            for k in range(L):
+                if s - k - 1 < 0:
+                    break
+                if fixed[s - k - 1]:
+                    l = s - k - 1
+                    consl = True
+                    break
+            for k in range(L):
+                if s + k + 1 >= T:
+                    break
+                if fixed[s + k + 1]:
+                    r = s + k + 1
+                    consr = True
+                    break
+            if not consl and not consr:
+                continue
+            if consl and consr:
+                litp = lerp(alpha(1.0 * (s - l + 1) / (L + 1)),
+                            glb[s, fidx], glb[l, fidx])
+                ritp = lerp(alpha(1.0 * (r - s + 1) / (L + 1)),
+                            glb[s, fidx], glb[r, fidx])
+                itp = lerp(alpha(1.0 * (s - l + 1) / (r - l + 1)),
+                           ritp, litp)
+                glb[s, fidx] = itp.copy()
+                continue
+            if consl:
+                litp = lerp(alpha(1.0 * (s - l + 1) / (L + 1)),
+                            glb[s, fidx], glb[l, fidx])
+                glb[s, fidx] = litp.copy()
+                continue
+            if consr:
+                ritp = lerp(alpha(1.0 * (r - s + 1) / (L + 1)),
+                            glb[s, fidx], glb[r, fidx])
+                glb[s, fidx] = ritp.copy()
+
+    return glb
+
+
+def bench_contact_targets(args):
+    from models.tmp import IK
+
+    rng = np.random.RandomState(0)
+    fid = [4, 3, 1, 2]
+    glb = rng.randn(args.clips, args.frames, 6, 3).astype(np.float32)
+    # contact runs of random lengths, like feet planted for a few frames
+    contact = np.repeat(rng.rand(args.clips, args.frames, len(fid)) < 0.5, rng.randint(1, 8, size=args.frames), axis=1)
+    contact = contact[:, :args.frames].astype(int)
+
+    time_ref, res_ref = timeit(lambda: np.stack([legacy_contact_targets(glb[i], contact[i], fid)
+                                                 for i in range(args.clips)]), args.repeat)
+    time_new, res_new = timeit(lambda: IK.get_contact_targets_batch(glb, contact, fid), args.repeat)
+    assert np.array_equal(res_ref, res_new), np.abs(res_ref - res_new).max()
+    report('contact targets ({} clips x {} frames)'.format(args.clips, args.frames), time_ref, time_new)
+
+
+""" Skeleton topology """
+
+
+def legacy_find_neighbor(edges, d):
+    """ nested list Floyd-Warshall of the original calc_edge_mat, then the neighbours of find_neighbor """
+    edge_num = len(edges)
+    edge_mat = [[100000] * edge_num for _ in range(edge_num)]
+    for i in range(edge_num):
+        edge_mat[i][i] = 0
+    for i, a in enumerate(edges):
+        for j, b in enumerate(edges):
+            link = 0
+            for x in range(2):
+                for y in range(2):
+                    if a[x] == b[y]:
+                        link = 1
+            if link:
+                edge_mat[i][j] = 1
+    for k in range(edge_num):
+        for i in range(edge_num):
+            for j in range(edge_num):
+                edge_mat[i][j] = min(edge_mat[i][j], edge_mat[i][k] + edge_mat[k][j])
+
+    neighbor_list = [[j for j in range(edge_num) if edge_mat[i][j] <= d] for i in range(edge_num)]
+    global_part_neighbor = neighbor_list[0].copy()
+    for i in global_part_neighbor:
+        neighbor_list[i].append(edge_num)
+    neighbor_list.append(global_part_neighbor)
+    return neighbor_list
+
+
+def bench_skeleton_topology(args):
+    from models import skeleton
+
+    rng = np.random.RandomState(0)
+    parents = [int(rng.randint(i)) for i in range(1, args.joints)]
+    edges = [[pa, i + 1, rng.randn(3)] for i, pa in enumerate(parents)]
+
+    def new_find_neighbor():
+        # cold: the topology is rebuilt every call
+        skeleton._skeleton_topologies.clear()
+        return skeleton.find_neighbor(edges, 2)
+
+    time_ref, res_ref = timeit(lambda: legacy_find_neighbor(edges, 2), args.repeat)
+    time_new, res_new = timeit(new_find_neighbor, args.repeat)
+    assert res_ref == res_new
+    report('find_neighbor, {} joints (uncached)'.format(args.joints), time_ref, time_new)
+
+    time_cached, res_cached = timeit(lambda: skeleton.find_neighbor(edges, 2), args.repeat)
+    assert res_ref == res_cached
+    report('find_neighbor, {} joints (cached)'.format(args.joints), time_ref, time_cached)
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--repeat', type=int, default=3)
+    subparsers = parser.add_subparsers(dest='benchmark')
+    subparsers.required = True
+
+    sub = subparsers.add_parser('bvh_load', help='BVH_mod.load vs BVH_fast.load')
+    sub.add_argument('files', nargs='+')
+    sub.add_argument('--scale', type=int, default=10, help='repeat the motion rows to make long clips')
+    sub.set_defaults(func=bench_bvh_load)
+
+    sub = subparsers.add_parser('euler_to_quaternion', help='per window vs batched conversion, numpy vs torch')
+    sub.add_argument('--frames', type=int, default=20000)
+    sub.add_argument('--joints', type=int, default=22)
+    sub.set_defaults(func=bench_euler_to_quaternion)
+
+    sub = subparsers.add_parser('attention', help='explicit vs fused attention, outputs must match')
+    sub.add_argument('--batch_size', type=int, default=16)
+    sub.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    sub.set_defaults(func=bench_attention)
+
+    sub = subparsers.add_parser('gan_step', help='legacy vs split GAN training step and micro-batches: time and memory')
+    sub.add_argument('--batch_size', type=int, default=16)
+    sub.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    sub.set_defaults(func=bench_gan_step)
+
+    sub = subparsers.add_parser('fk', help='joint loop vs depth-level forward kinematics')
+    sub.add_argument('--character', type=str, default='Aj')
+    sub.add_argument('--batch_size', type=int, default=64)
+    sub.add_argument('--frames', type=int, default=128)
+    sub.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    sub.set_defaults(func=bench_fk)
+
+    sub = subparsers.add_parser('rotation', help='per-element fill vs single stack rotation matrices')
+    sub.add_argument('--size', type=int, default=500000)
+    sub.add_argument('--device', type=str, default='cuda' if torch.cuda.is_available() else 'cpu')
+    sub.set_defaults(func=bench_rotation)
+
+    sub = subparsers.add_parser('contact_targets', help='frame loop vs run-length foot contact targets, must be identical')
+    sub.add_argument('--clips', type=int, default=64)
+    sub.add_argument('--frames', type=int, default=1024)
+    sub.set_defaults(func=bench_contact_targets)
+
+    sub = subparsers.add_parser('skeleton_topology', help='python Floyd-Warshall vs cached topology index, neighbours must match')
+    sub.add_argument('--joints', type=int, default=64)
+    sub.set_defaults(func=bench_skeleton_topology)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+import torch
+from datasets.skeleton_registry import get_bvh_writer
+
+
+def write_motions(character, motions, order, paths):
+    # motions: (bs, frame, DoF) numpy array
+    bvh_writer = get_bvh_writer(character)
+    bvh_writer.write_raw_batch(motions, order, paths)
+    return len(paths)
+
+
+class BVHExporter:
+    """
+    Write BVH files of motion batches in a process pool so that training does not wait on disk.
+    Motions are detached and copied to cpu on submit.
+    At most max_pending batches are in flight; submit() blocks on the oldest one beyond that.
+    num_workers=0 writes synchronously in the calling process.
+    The workers are forked in the constructor: create the exporter before CUDA is initialized
+    or threads are started (wandb), forking a process with either is unsafe.
+    """
+    def __init__(self, num_workers=2, max_pending=8):
+        self.num_workers = num_workers
+        self.max_pending = max(1, max_pending)
+        self.pending = []
+        self.pool = None
+        if num_workers > 0:
+            # fork: the training scripts run at import time and can not be re-imported by spawned workers
+            self.pool = ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context('fork'))
+            # with fork every worker is started on the first task, start them now and not at the first export
+            self.pool.submit(int).result()
+
+    def submit(self, character, motions, order, paths):
+        if isinstance(motions, torch.Tensor):
+            motions = motions.detach().cpu().numpy()
+        motions = motions[:len(paths)]
+
+        if self.pool is None:
+            write_motions(character, motions, order, paths)
+            return
+
+        self.wait(self.max_pending - 1)
+        self.pending.append(self.pool.submit(write_motions, character, motions, order, list(paths)))
+
+    def wait(self, max_pending):
+        """ block until at most max_pending batches are in flight """
+        while len(self.pending) > max_pending:
+            self.pending.pop(0).result()
+
+    def flush(self):
+        self.wait(0)
+
+    def close(self):
+        self.flush()
+        if self.pool is not None:
+            self.pool.shutdown()
+            self.pool = None
@@ -2,7 +2,7 @@ import sys
 import torch
 from wandb import set_trace
 sys.path.append("./utils")
-import BVH_mod as BVH
+import BVH_fast as BVH
 import numpy as np
 from Quaternions import Quaternions
 from models.Kinematics import ForwardKinematics
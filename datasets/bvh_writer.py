@@ -6,17 +6,15 @@ import numpy as np
 from utils.Quaternions import Quaternions
 from models.skeleton import build_joint_topology
 
-# rotation with shape frame * J * 3
-def write_bvh(parent, offset, rotation, position, names, frametime, order, path, endsite=None):
-    file = open(path, 'w')
-    frame = rotation.shape[0]
-    joint_num = rotation.shape[1]
-    order = order.upper()
+BLOCK_SIZE = 256  # frames formatted at once
 
-    file_string = 'HIERARCHY\n'
+
+def get_hierarchy(parent, offset, names, order, joint_num, frame, frametime):
+    """ HIERARCHY and MOTION header of a bvh file """
+    order = order.upper()
+    lines = ['HIERARCHY\n']
 
     def write_static(idx, prefix):
-        nonlocal parent, offset, rotation, names, order, endsite, file_string
         if idx == 0:
             name_label = 'ROOT ' + names[idx]
             channel_label = 'CHANNELS 6 Xposition Yposition Zposition {}rotation {}rotation {}rotation'.format(*order)
@@ -25,67 +23,105 @@ def write_bvh(parent, offset, rotation, position, names, frametime, order, path,
             channel_label = 'CHANNELS 3 {}rotation {}rotation {}rotation'.format(*order)
         offset_label = 'OFFSET %.6f %.6f %.6f' % (offset[idx][0], offset[idx][1], offset[idx][2])
 
-        file_string += prefix + name_label + '\n'
-        file_string += prefix + '{\n'
-        file_string += prefix + '\t' + offset_label + '\n'
-        file_string += prefix + '\t' + channel_label + '\n'
+        lines.append(prefix + name_label + '\n')
+        lines.append(prefix + '{\n')
+        lines.append(prefix + '\t' + offset_label + '\n')
+        lines.append(prefix + '\t' + channel_label + '\n')
 
         has_child = False
-        for y in range(idx+1, rotation.shape[1]):
+        for y in range(idx+1, joint_num):
             if parent[y] == idx:
                 has_child = True
                 write_static(y, prefix + '\t')
         if not has_child:
-            file_string += prefix + '\t' + 'End Site\n'
-            file_string += prefix + '\t' + '{\n'
-            file_string += prefix + '\t\t' + 'OFFSET 0 0 0\n'
-            file_string += prefix + '\t' + '}\n'
+            lines.append(prefix + '\t' + 'End Site\n')
+            lines.append(prefix + '\t' + '{\n')
+            lines.append(prefix + '\t\t' + 'OFFSET 0 0 0\n')
+            lines.append(prefix + '\t' + '}\n')
 
-        file_string += prefix + '}\n'
+        lines.append(prefix + '}\n')
 
     write_static(0, '')
 
-    file_string += 'MOTION\n' + 'Frames: {}\n'.format(frame) + 'Frame Time: %.8f\n' % frametime
-    for i in range(frame):
-        file_string += '%.6f %.6f %.6f ' % (position[i][0], position[i][1], position[i][2])
-        for j in range(joint_num):
-            file_string += '%.6f %.6f %.6f ' % (rotation[i][j][0], rotation[i][j][1], rotation[i][j][2])
-        file_string += '\n'
+    lines.append('MOTION\n' + 'Frames: {}\n'.format(frame) + 'Frame Time: %.8f\n' % frametime)
+    return ''.join(lines)
+
+
+def write_frames(file, rotation, position):
+    """ stream frame rows (root position, then rotation of each joint) in formatted blocks """
+    frame = rotation.shape[0]
+    rows = np.concatenate((position.reshape(frame, -1), rotation.reshape(frame, -1)), axis=1)
+    row_format = '%.6f ' * rows.shape[1] + '\n'
+    for begin in range(0, frame, BLOCK_SIZE):
+        block = rows[begin:begin + BLOCK_SIZE]
+        file.write((row_format * block.shape[0]) % tuple(block.ravel().tolist()))
+
+
+# rotation with shape frame * J * 3
+def write_bvh(parent, offset, rotation, position, names, frametime, order, path, endsite=None):
+    hierarchy = get_hierarchy(parent, offset, names, order, rotation.shape[1], rotation.shape[0], frametime)
+    with open(path, 'w') as file:
+        file.write(hierarchy)
+        write_frames(file, rotation, position)
+
 
-    file.write(file_string)
-    return file_string
+# rotations with shape clip * frame * J * 3, positions with shape clip * frame * 3
+def write_bvh_batch(parent, offset, rotations, positions, names, frametime, order, paths):
+    """ write many clips of the same skeleton, the hierarchy is built once """
+    hierarchy = get_hierarchy(parent, offset, names, order, rotations.shape[2], rotations.shape[1], frametime)
+    for rotation, position, path in zip(rotations, positions, paths):
+        with open(path, 'w') as file:
+            file.write(hierarchy)
+            write_frames(file, rotation, position)
 
 
 class BVH_writer():
     def __init__(self, edges, names):
         self.parent, self.offset, self.names, self.edge2joint = build_joint_topology(edges, names) 
         self.joint_num = len(self.parent)
-        
-    # position, rotation with shape T * J * (3/4)
-    def write(self, rotations, positions, order, path, frametime=1.0/30, offset=None, root_y=None):
+
+    @classmethod
+    def from_skeleton(cls, skeleton):
+        # skeleton: CharacterSkeleton with precomputed writer tables
+        writer = cls.__new__(cls)
+        writer.parent, writer.offset, writer.names, writer.edge2joint = \
+            skeleton.parent, skeleton.writer_offset, skeleton.writer_names, skeleton.edge2joint
+        writer.joint_num = len(writer.parent)
+        return writer
+
+    # rotations with shape (..., T, J, 3/4) -> euler rotations of every joint (..., T, joint_num, 3), order
+    def to_joint_rotations(self, rotations, order, root_y=None):
         if order == 'quaternion':
-            norm = rotations[:, :, 0] ** 2 + rotations[:, :, 1] ** 2 + rotations[:, :, 2] ** 2 + rotations[:, :, 3] ** 2
-            norm = np.repeat(norm[:, :, np.newaxis], 4, axis=2)
-            rotations /= norm
+            # numpy on purpose: torch atan2 / asin differ by ulps, written files stay byte-identical
+            norm = rotations[..., 0] ** 2 + rotations[..., 1] ** 2 + rotations[..., 2] ** 2 + rotations[..., 3] ** 2
+            rotations = rotations / norm[..., np.newaxis]
             rotations = Quaternions(rotations)
             rotations = np.degrees(rotations.euler())
             order = 'xyz'
 
-        rotations_full = np.zeros((rotations.shape[0], self.joint_num, 3))
+        rotations_full = np.zeros(rotations.shape[:-2] + (self.joint_num, 3))
 
         """ root 을 반영한 rotation 을 만들어줌 """
-        for idx, edge in enumerate(self.edge2joint):
-            if edge != -1:
-                rotations_full[:, idx, :] = rotations[:, edge, :]
-            else: print("error! ") # edge should not be -1 (not virtual)
-        if root_y is not None: rotations_full[0, 0, 1] = root_y
+        if -1 in self.edge2joint: print("error! ") # edge should not be -1 (not virtual)
+        edge2joint = [edge for edge in self.edge2joint if edge != -1]
+        index = [idx for idx, edge in enumerate(self.edge2joint) if edge != -1]
+        rotations_full[..., index, :] = rotations[..., edge2joint, :]
+        if root_y is not None: rotations_full[..., 0, 0, 1] = root_y
+
+        return rotations_full, order
+
+    # position, rotation with shape T * J * (3/4)
+    def write(self, rotations, positions, order, path, frametime=1.0/30, offset=None, root_y=None):
+        rotations_full, order = self.to_joint_rotations(rotations, order, root_y)
 
         if offset is None: offset = self.offset
         return write_bvh(self.parent, offset, rotations_full, positions, self.names, frametime, order, path)
 
+    # motion with shape T * DoF
     def write_raw(self, motion, order, path, frametime=1.0/30, root_y=None):
         # motion = motion.permute(1, 0).detach().cpu().numpy()  # (bs,dof,window) -> (bs,window,dof)
-        motion = motion.detach().cpu().numpy()        
+        if not isinstance(motion, np.ndarray):
+            motion = motion.detach().cpu().numpy()
         rotations = motion[:, :-3] # rotation 은 앞에서 부터 뒤의 3개 전까지 
         positions = motion[:, -3:] # position 은 뒤에 3개
         
@@ -95,3 +131,19 @@ class BVH_writer():
             rotations = rotations.reshape((motion.shape[0], -1, 3))
 
         return self.write(rotations, positions, order, path, frametime, root_y=root_y)
+
+    # motions with shape clip * T * DoF, converted together and written with one shared hierarchy
+    def write_raw_batch(self, motions, order, paths, frametime=1.0/30):
+        if not isinstance(motions, np.ndarray):
+            motions = motions.detach().cpu().numpy()
+        motions = motions[:len(paths)]
+        rotations = motions[..., :-3]
+        positions = motions[..., -3:]
+
+        if order == 'quaternion':
+            rotations = rotations.reshape(motions.shape[:2] + (-1, 4))
+        else:
+            rotations = rotations.reshape(motions.shape[:2] + (-1, 3))
+
+        rotations_full, order = self.to_joint_rotations(rotations, order)
+        write_bvh_batch(self.parent, self.offset, rotations_full, positions, self.names, frametime, order, paths)
@@ -1,5 +1,6 @@
 from json.encoder import py_encode_basestring
-from torch.utils.data import Dataset
+from torch.utils.data import Dataset, Sampler
+import math
 import copy
 
 from wandb import set_trace
@@ -7,7 +8,7 @@ from datasets.motion_dataset import MotionData
 import os
 import numpy as np
 import torch
-from datasets.bvh_parser import BVH_file
+from datasets.skeleton_registry import get_skeleton
 from option_parser import get_std_bvh
 from datasets import get_test_set
 from datasets import get_validation_set
@@ -15,25 +16,136 @@ import sys
 sys.path.append("./utils")
 from Quaternions import Quaternions
 
+def to_device(tensors, device):
+    """ copy of a (nested list of) tensors on device """
+    if isinstance(tensors, torch.Tensor):
+        return tensors.to(device)
+    return [to_device(t, device) for t in tensors]
+
+
 class MixedData0(Dataset):
-    """ Mixed data for many skeletons but one topologies """
-    def __init__(self, args, motions):
+    """
+    Mixed data for many skeletons but one topologies
+    the first num_motions windows of each character, fetched lazily from the MotionData of the character
+    """
+    def __init__(self, args, datasets, num_motions):
         super(MixedData0, self).__init__()
-        self.motions = motions
-        self.motions_reverse = torch.tensor(self.motions.numpy()[..., ::-1].copy())
+        self.datasets = datasets
+        self.num_motions = num_motions
         # self.skeleton_idx = skeleton_idx
-        self.length = motions.shape[0]
+        self.length = num_motions * len(datasets)
         self.args = args
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, item):
-        if self.args.data_augment == 0: # or torch.rand(1) < 0.5:
-            return self.motions[item]
-        else:
-            print("reversed MixedData0")
-            return self.motions_reverse[item]
+        return self.get(item)
+
+    def get(self, item, reverse=False):
+        if isinstance(item, int):
+            character_idx, motion_idx = divmod(item % self.length, self.num_motions)
+            return self.datasets[character_idx].get_windows(motion_idx, reverse)
+
+        # a contiguous block inside one character is a single gather from its frames
+        if isinstance(item, slice) and item.step in (None, 1):
+            start, stop, _ = item.indices(self.length)
+            character_idx = start // self.num_motions
+            if stop > start and (stop - 1) // self.num_motions == character_idx:
+                begin = character_idx * self.num_motions
+                return self.datasets[character_idx].get_windows(slice(start - begin, stop - begin), reverse)
+
+        indices = torch.arange(self.length)[item].cpu()
+        character_ids = indices // self.num_motions
+        motion_ids = indices % self.num_motions
+        result = None
+        for character_idx in character_ids.unique().tolist():
+            mask = character_ids == character_idx
+            windows = self.datasets[character_idx].get_windows(motion_ids[mask], reverse)
+            if result is None:
+                result = windows.new_empty((indices.size(0),) + windows.shape[1:])
+            result[mask.to(result.device)] = windows
+        return result
+
+    def get_motion_ids(self, item):
+        """ index of each window of item inside its character (the motion_idx of the window) """
+        if isinstance(item, int):
+            return torch.tensor(item % self.length % self.num_motions)
+        if isinstance(item, torch.Tensor):
+            return item.cpu() % self.num_motions
+        return torch.arange(self.length)[item] % self.num_motions
+
+    def get_character(self, character_idx, motion_ids, reverse=False):
+        """ windows of one character, motion_ids: index tensor (can be on the device of the dataset) """
+        return self.datasets[character_idx].get_windows(motion_ids, reverse)
+
+    def to(self, device):
+        # the same MotionData can appear in both groups
+        for dataset in {id(d): d for d in self.datasets}.values():
+            dataset.to(device)
+        return self
+
+
+class CharacterBatchSampler(Sampler):
+    """
+    Contiguous batches as slices (use with DataLoader(batch_size=None)).
+    The dataset is num_motions windows per character, one after another; a batch never crosses characters.
+    shuffle: windows are shuffled inside each character, batches are then index tensors
+    (the dataset returns the motion ids of each batch, so the windows can still be told apart)
+    """
+    def __init__(self, length, num_motions, batch_size, shuffle=False):
+        self.length = length
+        self.num_motions = num_motions
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+
+    def __iter__(self):
+        for character_begin in range(0, self.length, self.num_motions):
+            character_end = min(character_begin + self.num_motions, self.length)
+            if self.shuffle:
+                order = character_begin + torch.randperm(character_end - character_begin)
+            for begin in range(character_begin, character_end, self.batch_size):
+                end = min(begin + self.batch_size, character_end)
+                if self.shuffle:
+                    yield order[begin - character_begin:end - character_begin]
+                else:
+                    yield slice(begin, end)
+
+    def __len__(self):
+        return get_num_batches(self.length, self.num_motions, self.batch_size)
+
+
+def get_num_batches(length, num_motions, batch_size):
+    n_character, rest = divmod(length, num_motions)
+    return n_character * math.ceil(num_motions / batch_size) + math.ceil(rest / batch_size)
+
+
+class DeviceBatchLoader:
+    """
+    Loader for a dataset moved to the gpu with dataset.to(device) (--device_dataset).
+    Batches are gathered on device from per-character index tensors, shuffling (randperm) and
+    reversal also run there, so there is no host to device copy in the training loop.
+    Like the sampled dataset, every batch is (source motion, gt target motion, motion ids inside the character).
+    """
+    def __init__(self, dataset, batch_size, shuffle=False):
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.num_motions = dataset.gt.num_motions
+        self.num_characters = len(dataset.gt.datasets)
+        self.device = dataset.gt.datasets[0].window_starts.device
+
+    def __len__(self):
+        return get_num_batches(self.num_motions * self.num_characters, self.num_motions, self.batch_size)
+
+    def __iter__(self):
+        for character_idx in range(self.num_characters):
+            if self.shuffle:
+                order = torch.randperm(self.num_motions, device=self.device)
+            else:
+                order = torch.arange(self.num_motions, device=self.device)
+            for begin in range(0, self.num_motions, self.batch_size):
+                yield self.dataset.get_batch(character_idx, order[begin:begin + self.batch_size])
 
 
 """ MixedData:  """
@@ -41,7 +153,7 @@ class MixedData(Dataset):
     """ data_gruop_num * 2 * samples """
     def __init__(self, args, character_groups): # characters
         self.args = args
-        device = torch.device(args.cuda_device if (torch.cuda.is_available()) else 'cpu')
+        # dataset state stays on cpu (shared memory) so loader workers can use it, batches are moved in the loop
         self.final_data = []
         self.enc_inputs = []
         self.dec_inputs = []
@@ -72,6 +184,7 @@ class MixedData(Dataset):
             for i, character in enumerate(characters):
                 args.dataset = character
                 motion = MotionData(args, 0)
+                motion.share_memory()
                 motion_data.append(motion)
                 total_length = min(total_length, len(motion_data[-1]))
 
@@ -86,7 +199,7 @@ class MixedData(Dataset):
                 means_group.append(mean)
                 vars_group.append(var)
 
-                file = BVH_file(get_std_bvh(dataset=character))
+                file = get_skeleton(character)
                 if i == 0:
                     self.joint_topologies.append(file.topology)
                     self.ee_ids.append(file.get_ee_id())
@@ -98,50 +211,48 @@ class MixedData(Dataset):
             all_datas.append(motion_data)
 
             offsets_group = torch.cat(offsets_group, dim=0)
-            offsets_group = offsets_group.to(device)
+            offsets_group = offsets_group.share_memory_()
             self.offsets_group.append(offsets_group)
             self.offsets.append(offsets_group)
 
             # (4,1,91,1 -> 4,91,1)
-            means_group = torch.cat(means_group, dim=0).to(device)
-            vars_group = torch.cat(vars_group, dim=0).to(device)
+            means_group = torch.cat(means_group, dim=0).share_memory_()
+            vars_group = torch.cat(vars_group, dim=0).share_memory_()
             self.means.append(means_group)
             self.vars.append(vars_group)
         
         """ Get final """
         for group_idx, datasets in enumerate(all_datas): # final_data: (2, 424, 913, 91) for 2 groups
-            motions = []
             # 총 모션의 갯수가  batch_size의 배수가 되게 하기 위한 Cropping
             num_motions = int(len(datasets[0]) / args.batch_size) * args.batch_size
             print("max_length: ", num_motions)
             args.num_motions = num_motions
             
-            for character_idx, dataset in enumerate(datasets): # for each character in a group
-                motions.append(dataset[:num_motions])
-
-            # (4,106, 91, 913) -> (424, 91, 913),  (4,51,138,128) -> (204,138,128)
-            motions = torch.cat(motions, dim=0)
-            self.length = motions.size(0)
-            self.final_data.append(MixedData0(args, motions))
+            # (4,106, 91, 913) -> (424, 91, 913),  (4,51,138,128) -> (204,138,128), windows are fetched lazily
+            final_data = MixedData0(args, datasets, num_motions)
+            self.length = len(final_data)
+            self.final_data.append(final_data)
         
         """ Get enc / dec input motions """
-        self.gt = self.final_data[1][:] 
-        self.enc_inputs = self.final_data[0][:] 
-        self.dec_inputs = self.final_data[1][:] 
+        self.gt = self.final_data[1]
+        self.enc_inputs = self.final_data[0]
+        self.dec_inputs = self.final_data[1]
         
         """ update input/output dimension of network: Set DoF  """
+        enc_window = self.enc_inputs[0]
+        dec_window = self.dec_inputs[0]
         #swap_dim=0: (bs, Window, DoF) 
         if args.swap_dim == 0:
-            args.input_size = self.enc_inputs.size(2)
-            args.output_size = self.dec_inputs.size(2)
+            args.input_size = enc_window.size(1)
+            args.output_size = dec_window.size(1)
         #swap_dim=1: (bs, DoF, Window)
         else: 
-            args.input_size = self.enc_inputs.size(1)
-            args.output_size = self.dec_inputs.size(1)
+            args.input_size = enc_window.size(0)
+            args.output_size = dec_window.size(0)
 
     def denorm(self, gid, pid, data):
-        means = self.means[gid][pid, ...]
-        var = self.vars[gid][pid, ...]
+        means = self.means[gid][pid, ...].to(data.device, non_blocking=True)
+        var = self.vars[gid][pid, ...].to(data.device, non_blocking=True)
         # data_tmp = data 
         data = data * var + means
 
@@ -152,16 +263,39 @@ class MixedData(Dataset):
         #         data[:,-3:,:] = data_tmp[:,-3:,:]
         return data
 
-    def get_offsets(self):
-        return self.offsets
+    def get_offsets(self, device=None):
+        if device is None:
+            return self.offsets
+        return to_device(self.offsets, device)
+
+    def get_batch_sampler(self, batch_size, shuffle=False):
+        return CharacterBatchSampler(self.length, self.gt.num_motions, batch_size, shuffle)
+
+    def get_batch(self, character_idx, motion_ids):
+        """ (source motion, gt target motion, motion ids) of one character, gathered where the dataset is """
+        reverse = self.args.data_augment != 0 and torch.randint(0, 2, (1,)).item() == 1
+        return (self.enc_inputs.get_character(character_idx, motion_ids, reverse),
+                self.gt.get_character(character_idx, motion_ids, reverse),
+                motion_ids)
+
+    def to(self, device):
+        """ upload the dataset once (--device_dataset) """
+        for final_data in self.final_data:
+            final_data.to(device)
+        self.means = to_device(self.means, device)
+        self.vars = to_device(self.vars, device)
+        return self
 
     def __len__(self):
         return self.length
 
     def __getitem__(self, item):
-        return (torch.as_tensor(self.enc_inputs[item].data),    # source motion
-                torch.as_tensor(self.dec_inputs[item].data),    # decoder source motion
-                torch.as_tensor(self.gt[item].data)) # gt target motion
+        # the same reversal is applied to the source and the target motion
+        reverse = self.args.data_augment != 0 and torch.randint(0, 2, (1,)).item() == 1
+        # decoder source motion is the gt target motion itself, it is returned once and used by reference
+        return (self.enc_inputs.get(item, reverse),    # source motion
+                self.gt.get(item, reverse), # gt target motion
+                self.gt.get_motion_ids(item)) # index of each window inside its character, names the written files
 
 
 class TestData(Dataset):
@@ -169,7 +303,6 @@ class TestData(Dataset):
         # self.characters = characters
         # self.file_list = get_test_set()
         self.args = args
-        self.device = torch.device(args.cuda_device)
         self.final_data = []
         all_datas = []
         self.offsets = []
@@ -183,9 +316,10 @@ class TestData(Dataset):
             vars_group = []
 
             for j, character in enumerate(characters):
-                file = BVH_file(get_std_bvh(dataset=character))
+                file = get_skeleton(character)
                 args.dataset = character
                 motion = MotionData(args, 0)
+                motion.share_memory()
                 motion_data.append(motion)
                 
                 new_offset = file.offset
@@ -211,8 +345,8 @@ class TestData(Dataset):
             # offsets_group = offsets_group.to(self.device)
             self.offsets.append(offsets_group)
 
-            means_group = torch.cat(means_group, dim=0).to(self.device)
-            vars_group = torch.cat(vars_group, dim=0).to(self.device)
+            means_group = torch.cat(means_group, dim=0).share_memory_()
+            vars_group = torch.cat(vars_group, dim=0).share_memory_()
 
             self.offsets.append(offsets_group)
             self.means.append(means_group)
@@ -220,31 +354,28 @@ class TestData(Dataset):
 
         """ Get final """
         for group_idx, datasets in enumerate(all_datas): 
-            motions = []
             max_length = int( len(datasets[0]) / args.batch_size) * args.batch_size 
             args.num_motions = max_length
-            for character_idx, dataset in enumerate(datasets):
-                motions.append(dataset[:max_length])
 
-            # (4,106, 91, 913) -> (424, 91, 913),  (4,51,138,128) -> (204,138,128)
-            motions = torch.cat(motions, dim=0)          
-            self.length = motions.size(0)
-            self.final_data.append(MixedData0(args, motions))
+            # (4,106, 91, 913) -> (424, 91, 913),  (4,51,138,128) -> (204,138,128), windows are fetched lazily
+            final_data = MixedData0(args, datasets, max_length)
+            self.length = len(final_data)
+            self.final_data.append(final_data)
         
         """ Get enc / dec input motions """
-        self.gt = self.final_data[1][:] 
-        self.enc_inputs = self.final_data[0][:] 
-        self.dec_inputs = self.final_data[1][:] 
+        self.gt = self.final_data[1]
+        self.enc_inputs = self.final_data[0]
+        self.dec_inputs = self.final_data[1]
         
         """ update input/output dimension of network """
         # swap == 0: input / output DoF
         # swap == 1: window_size 
-        args.input_size = self.enc_inputs.size(2)
-        args.output_size = self.dec_inputs.size(2)
+        args.input_size = self.enc_inputs[0].size(1)
+        args.output_size = self.dec_inputs[0].size(1)
 
     def denorm(self, gid, pid, data):
-        means = self.means[gid][pid, ...]
-        var = self.vars[gid][pid, ...]
+        means = self.means[gid][pid, ...].to(data.device, non_blocking=True)
+        var = self.vars[gid][pid, ...].to(data.device, non_blocking=True)
         # data_tmp = data 
         data = data * var + means
 
@@ -256,14 +387,37 @@ class TestData(Dataset):
         return data
 
 
-    def get_offsets(self):
-        return self.offsets
+    def get_offsets(self, device=None):
+        if device is None:
+            return self.offsets
+        return to_device(self.offsets, device)
+
+    def get_batch_sampler(self, batch_size, shuffle=False):
+        return CharacterBatchSampler(self.length, self.gt.num_motions, batch_size, shuffle)
+
+    def get_batch(self, character_idx, motion_ids):
+        """ (source motion, gt target motion, motion ids) of one character, gathered where the dataset is """
+        reverse = self.args.data_augment != 0 and torch.randint(0, 2, (1,)).item() == 1
+        return (self.enc_inputs.get_character(character_idx, motion_ids, reverse),
+                self.gt.get_character(character_idx, motion_ids, reverse),
+                motion_ids)
+
+    def to(self, device):
+        """ upload the dataset once (--device_dataset) """
+        for final_data in self.final_data:
+            final_data.to(device)
+        self.means = to_device(self.means, device)
+        self.vars = to_device(self.vars, device)
+        return self
 
     
     def __getitem__(self, item):
-        return (torch.as_tensor(self.enc_inputs[item].data),    # source motion
-                torch.as_tensor(self.dec_inputs[item].data),    # decoder source motion
-                torch.as_tensor(self.gt[item].data)) # gt target motion
+        # the same reversal is applied to the source and the target motion
+        reverse = self.args.data_augment != 0 and torch.randint(0, 2, (1,)).item() == 1
+        # decoder source motion is the gt target motion itself, it is returned once and used by reference
+        return (self.enc_inputs.get(item, reverse),    # source motion
+                self.gt.get(item, reverse), # gt target motion
+                self.gt.get_motion_ids(item)) # index of each window inside its character, names the written files
 
     def __len__(self):
         return self.length
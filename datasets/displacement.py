@@ -0,0 +1,46 @@
+import torch
+
+""" root position <-> per-frame displacement codec """
+# The root position is stored in the last 3 channels of every frame.
+# swap_dim=0: (bs, frame, DoF), swap_dim=1: (bs, DoF, frame)
+
+
+def _get_dims(motions, swap_dim):
+    # (frame dim, channel dim)
+    if swap_dim == 0:
+        return motions.dim() - 2, motions.dim() - 1
+    else:
+        return motions.dim() - 1, motions.dim() - 2
+
+
+def encode_root_displacement(motions, swap_dim=0):
+    """
+    absolute root position -> displacement to the next frame.
+    disp[f] = pos[f + 1] - pos[f], the displacement of the last frame is set to 0.
+    """
+    frame_dim, channel_dim = _get_dims(motions, swap_dim)
+    num_DoF = motions.size(channel_dim)
+
+    root = motions.narrow(channel_dim, num_DoF - 3, 3)
+    disp = torch.diff(root, dim=frame_dim)
+    last = torch.zeros_like(root.narrow(frame_dim, 0, 1))
+
+    motions = motions.clone()
+    motions.narrow(channel_dim, num_DoF - 3, 3).copy_(torch.cat((disp, last), dim=frame_dim))
+    return motions
+
+
+def decode_root_displacement(motions, swap_dim=0):
+    """
+    displacement -> absolute root position, accumulated from the first frame.
+    pos[f + 1] = pos[f] + disp[f + 1]
+    """
+    frame_dim, channel_dim = _get_dims(motions, swap_dim)
+    num_DoF = motions.size(channel_dim)
+
+    root = motions.narrow(channel_dim, num_DoF - 3, 3)
+    root = torch.cumsum(root, dim=frame_dim)
+
+    motions = motions.clone()
+    motions.narrow(channel_dim, num_DoF - 3, 3).copy_(root)
+    return motions
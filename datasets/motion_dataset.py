@@ -1,5 +1,9 @@
 from Quaternions import Quaternions
 from option_parser import get_std_bvh
+from datasets.displacement import encode_root_displacement
+from datasets.motion_store import MotionStore, load_motions, load_converted_frames
+from datasets.motion_statistics import RunningStatistics
+from models.rotation import euler_to_quaternion
 from torch.utils.data import Dataset
 import os
 import sys
@@ -9,6 +13,60 @@ from wandb import set_trace
 sys.path.append("../")
 sys.path.append("./utils")
 
+def get_motion_frames(motion, args):
+    """
+    frames in the network representation: (frames, DoF)
+    the conversion is a single batched operation over all frames, so one call can convert every clip of a character.
+    torch tensors are converted with models.rotation on their own device
+    """
+    new = motion
+    if args.rotation == 'quaternion':
+        new = new.reshape(new.shape[0], -1, 3)
+        rotations = new[:, :-1, :]
+        positions = new[:, -1, :]
+        if isinstance(new, torch.Tensor):
+            rotations = euler_to_quaternion(torch.deg2rad(rotations))
+            rotations = rotations.reshape(rotations.shape[0], -1)
+            return torch.cat((rotations, positions), dim=1)
+
+        rotations = Quaternions.from_euler(
+            np.radians(rotations)).qs
+        rotations = rotations.reshape(rotations.shape[0], -1)
+        new = np.concatenate(
+            (rotations, positions), axis=1)
+    return new
+
+
+def get_window_starts(num_frame, args):
+    """ first frame of each half overlapping window of a clip """
+    step_size = args.window_size // 2
+    n_window = num_frame // step_size - 1  # -1 : 마지막 window에 데이터가 전부 차지 않았다면 제거
+    return np.arange(max(n_window, 0)) * step_size
+
+
+def get_motion_windows(motion, args):
+    """ half overlapping windows of a clip in the network representation: (n_window, window, DoF) or None """
+    starts = get_window_starts(motion.shape[0], args)
+    if len(starts) == 0:
+        return None
+    frames = get_motion_frames(motion, args)
+    window_size = args.window_size // 2 * 2
+    return frames[starts[:, np.newaxis] + np.arange(window_size)]
+
+
+def get_window_tensor(motion, args):
+    """ windows of a clip as stored in MotionData before normalization (root displacement, swap_dim applied) """
+    windows = get_motion_windows(motion, args)
+    if windows is None:
+        return None
+    windows = torch.tensor(windows, dtype=torch.float32)
+    if args.root_pos_disp == 1:
+        windows = encode_root_displacement(windows, swap_dim=0)
+    if args.swap_dim == 1:
+        windows = torch.transpose(windows, 1, 2)
+    return windows
+
+
 # for each characters
 
 
@@ -32,85 +90,46 @@ class MotionData(Dataset):
         self.total_frame = 0
         self.std_bvh = get_std_bvh(args)
         self.args = args
-        self.data = []
         self.motion_length = []
-        motions = np.load(file_path, allow_pickle=True)
-        motions = list(motions)
+        # memory mapped motion store if converted, pickled list of clips otherwise
+        motions = load_motions(file_path)
 
         print(file_path)
-        new_window = self.get_windows(motions)
-
-        # change data from list to tensor
-        self.data.append(new_window)
-        self.data = torch.cat(self.data)
-
-        """ Crop motion dimesnion """
-        # self.data = self.data[:, :-1, :]
-
-        """ Get motion info """
-        num_bs = self.data.size(0)
-        num_frames = self.data.size(1)
-        num_DoF = self.data.size(2)
-
-        """ Modify data  """
-        # root position -> displacement
-        if args.root_pos_disp == 1:
-            for bs in range(num_bs):  # 0차원(motions)에 대해
-                for frame in range(num_frames - 1):  # 2차원(frames)에 대해
-                    self.data[bs][frame][num_DoF - 3] = self.data[bs][frame +
-                                                                      1][num_DoF - 3] - self.data[bs][frame][num_DoF - 3]
-                    self.data[bs][frame][num_DoF - 2] = self.data[bs][frame +
-                                                                      1][num_DoF - 2] - self.data[bs][frame][num_DoF - 2]
-                    self.data[bs][frame][num_DoF - 1] = self.data[bs][frame +
-                                                                      1][num_DoF - 1] - self.data[bs][frame][num_DoF - 1]
-
-                # 마지막 프레임의 disp는 0으로 셋팅해줍니다.
-                self.data[bs][num_frames - 1][num_DoF - 3] = 0
-                self.data[bs][num_frames - 1][num_DoF - 2] = 0
-                self.data[bs][num_frames - 1][num_DoF - 1] = 0
-
-        """ Swap dimension: (bs, Windows, Joint) -> (bs, joint, windows) """
-        if args.swap_dim == 1:
-            self.data = torch.transpose(self.data, 1, 2)
+        """
+        Every clip is stored once in self.frames: (total frames, DoF).
+        Windows are not materialized, they are gathered from self.window_starts when fetched.
+        With a motion store, self.frames maps the frames converted once into the network representation
+        (self.mapped_frames), so only the pages of the gathered windows are read.
+        """
+        self.mapped_frames = False
+        if isinstance(motions, MotionStore):
+            self.frames, self.window_starts = self.get_store_frames(motions)
+        else:
+            self.frames, self.window_starts = self.get_frames(motions)
+        self.frame_range = torch.arange(args.window_size // 2 * 2)
 
         """ normalization data:  mean, var of data & normalization """
         if args.normalization:
             if preprocess:  # preprocess의 경우
-                self.mean = torch.mean(
-                    self.data, (0, 2), keepdim=True)  # (1,69,1)
-                self.var = torch.var(self.data, (0, 2), keepdim=True)
-                self.var = self.var ** (1/2)
-                idx = self.var < 1e-5
-                self.var[idx] = 1
+                statistics = self.get_statistics()
+                self.mean = torch.tensor(statistics.mean, dtype=torch.float32)  # (1,69,1)
+                self.var = torch.tensor(statistics.std, dtype=torch.float32)
             else:  # 일반적인 경우
                 self.mean = np.load(
                     './datasets/Mixamo/mean_var/{}_mean.npy'.format(name))
                 self.var = np.load(
                     './datasets/Mixamo/mean_var/{}_var.npy'.format(name))
 
-            # data_tmp = self.data
-            self.data = (self.data - self.mean) / self.var
-
-            # pos은 normalization에서 제거
-            # if args.root_pos_disp == 1:
-            #     if args.swap_dim == 0:
-            #         self.data[:,:,-3:] = data_tmp[:,:,-3:]
-            #     else:
-            #         self.data[:,-3:,:] = data_tmp[:,-3:,:]
+            # statistics of a single window: (69,1)
+            shape = tuple(self.mean.shape[-2:])
+            self.window_mean = torch.as_tensor(self.mean).reshape(shape)
+            self.window_var = torch.as_tensor(self.var).reshape(shape)
 
         else:
-            self.mean = torch.mean(self.data, (0, 2), keepdim=True)
-            self.mean.zero_()
+            window = self.gather_windows(0)
+            self.mean = torch.zeros((1, window.size(0), 1))
             self.var = torch.ones_like(self.mean)
 
-        """ save data """
-        # motion window 데이터의 6%을 테스트 데이터로 사용함
-        # train_len = self.data.shape[0] * 94 // 100
-
-        # self.data = self.data[:train_len, ...]
-        self.data_reverse = torch.tensor(self.data.numpy()[..., ::-1].copy())
-
-        # self.test_set = self.data[train_len:, ...]
         self.reset_length_flag = 0
         self.virtual_length = 0
 
@@ -125,16 +144,133 @@ class MotionData(Dataset):
         if self.reset_length_flag:
             return self.virtual_length
         else:
-            return self.data.shape[0]
+            return self.num_windows()
+
+    def share_memory(self):
+        """ move the frames to shared memory, loader workers then read them without a copy """
+        # memory mapped frames are already shared through the page cache
+        if not self.mapped_frames:
+            self.frames.share_memory_()
+        self.window_starts.share_memory_()
+        self.frame_range.share_memory_()
+        return self
+
+    def to(self, device):
+        """ keep the frames on device, windows are then gathered, normalized and reversed there """
+        self.frames = self.frames.to(device)
+        self.mapped_frames = self.mapped_frames and self.frames.device.type == 'cpu'
+        self.window_starts = self.window_starts.to(device)
+        self.frame_range = self.frame_range.to(device)
+        if self.args.normalization:
+            self.window_mean = self.window_mean.to(device)
+            self.window_var = self.window_var.to(device)
+        return self
+
+    def num_windows(self):
+        return self.window_starts.size(0)
 
     def __getitem__(self, item):
         if isinstance(item, int):
-            item %= self.data.shape[0]
-        if self.args.data_augment == 0 or np.random.randint(0, 2) == 0:
-            return self.data[item]
+            item %= self.num_windows()
+        # reversal augmentation is applied when a window is fetched
+        reverse = self.args.data_augment != 0 and torch.randint(0, 2, (1,)).item() == 1
+        return self.get_windows(item, reverse)
+
+    def get_windows(self, item, reverse=False):
+        """
+        normalized windows in the network representation
+        item: int -> (DoF, window) (swap_dim=1), slice / index tensor -> (n, DoF, window)
+        """
+        windows = self.gather_windows(item)
+        if self.args.normalization:
+            windows = (windows - self.window_mean) / self.window_var
+
+        if reverse:
+            windows = windows.flip(-1)
+        return windows
+
+    def gather_windows(self, item):
+        """ windows gathered from the clip frames, before normalization """
+        if isinstance(item, slice):
+            item = torch.arange(self.num_windows(), device=self.window_starts.device)[item]
+        starts = self.window_starts[item]
+        windows = self.frames[starts.unsqueeze(-1) + self.frame_range]  # (..., window, DoF)
+
+        # root position -> displacement, the last frame of each window has no next frame
+        if self.args.root_pos_disp == 1:
+            windows[..., -1, -3:] = 0
+
+        """ Swap dimension: (bs, Windows, Joint) -> (bs, joint, windows) """
+        if self.args.swap_dim == 1:
+            windows = torch.transpose(windows, -1, -2)
+        return windows
+
+    def get_frames(self, motions):
+        clips = []
+        window_starts = []
+        offset = 0
+
+        # motions : (motions, frames, joint DoF)
+        for motion in motions:
+            self.total_frame += motion.shape[0]
+            self.motion_length.append(motion.shape[0])
+
+            starts = get_window_starts(motion.shape[0], self.args)
+            if len(starts) == 0:
+                continue
+
+            clips.append(motion)
+            window_starts.append(torch.tensor(starts + offset, dtype=torch.long))
+            offset += motion.shape[0]
+        window_starts = self.check_window_starts(window_starts)
+
+        # rotation conversion once for all frames of the character
+        frames = torch.tensor(get_motion_frames(np.concatenate(clips), self.args), dtype=torch.float32)
+
+        # root position -> displacement: inside a window this equals the displacement of the whole clip
+        # (the last frame of a clip is only ever the last frame of a window, which is zeroed when fetched)
+        if self.args.root_pos_disp == 1:
+            frames = encode_root_displacement(frames, swap_dim=0)
+
+        return frames, window_starts
+
+    def get_store_frames(self, store):
+        """ frames of a motion store in the network representation, memory mapped when the conversion could be saved """
+        window_starts = []
+        for offset, length in store.index:
+            self.total_frame += int(length)
+            self.motion_length.append(int(length))
+            window_starts.append(torch.tensor(get_window_starts(int(length), self.args) + offset, dtype=torch.long))
+        window_starts = self.check_window_starts(window_starts)
+
+        key = self.args.rotation + ('_disp' if self.args.root_pos_disp == 1 else '')
+        frames = load_converted_frames(store, key, self.convert_clip)
+        if frames is None:
+            frames = np.concatenate([self.convert_clip(clip) for clip in store])
         else:
-            print("reversed")
-            return self.data_reverse[item]
+            self.mapped_frames = True
+        return torch.from_numpy(frames), window_starts
+
+    def convert_clip(self, motion):
+        """ (frames, DoF) clip -> (frames, DoF) float32 in the network representation, same as get_frames """
+        frames = torch.tensor(get_motion_frames(motion, self.args), dtype=torch.float32)
+        if self.args.root_pos_disp == 1:
+            frames = encode_root_displacement(frames, swap_dim=0)
+        return frames.numpy()
+
+    def check_window_starts(self, window_starts):
+        if sum(len(starts) for starts in window_starts) == 0:
+            raise ValueError('{}: no clip is long enough for a window of {} frames'.format(
+                self.args.dataset, self.args.window_size // 2 * 2))
+        return torch.cat(window_starts)
+
+    def get_statistics(self, chunk_size=1024):
+        """ mean / var over (windows, frames) of every channel, accumulated in chunks of windows """
+        statistics = RunningStatistics()
+        for begin in range(0, self.num_windows(), chunk_size):
+            windows = self.gather_windows(slice(begin, begin + chunk_size))
+            statistics.update(windows.numpy(), axis=(0, 2))
+        return statistics
 
     def get_motion_data(self, motions, max_frame):
         ret_motion = []
@@ -143,26 +279,13 @@ class MotionData(Dataset):
             self.total_frame += motion.shape[0]
             self.motion_length.append(motion.shape[0])
 
-            # new: (221, 69) : 22*3 + 3
-            new = motion
-            if self.args.rotation == 'quaternion':
-                # new: (221, 23, 3)
-                new = new.reshape(new.shape[0], -1, 3)
-
-                # rotations: (221, 22, 3) : euler to Quaternion
-                rotations = new[:, :-1, :]
-                rotations = Quaternions.from_euler(
-                    np.radians(rotations)).qs  # rotations: (221, 22, 4)
-                rotations = rotations.reshape(
-                    rotations.shape[0], -1)  # rotations: (221, 88)
-
-                # rotations (221,88) + positions(new[:,-1,:]) (221, 23, 3) -> (221, 91)
-                new = np.concatenate(
-                    (rotations, new[:, -1, :].reshape(new.shape[0], -1)), axis=1)
+        # new: (all frames, 69) : 22*3 + 3 -> (all frames, 91) rot + pos, converted at once
+        frames = get_motion_frames(np.concatenate(motions), self.args)
+        frames = torch.tensor(frames, dtype=torch.float32)
 
+        for motion, new in zip(motions, torch.split(frames, [len(motion) for motion in motions])):
             # (1, frames, 91)
-            new = new[np.newaxis, ...]
-            new_window = torch.tensor(new, dtype=torch.float32)
+            new_window = new.unsqueeze(0)
 
             # add padding
             if len(motion) < max_frame:
@@ -183,38 +306,5 @@ class MotionData(Dataset):
                 max_length = len(motions[i])
         return max_length
 
-    def get_windows(self, motions):
-        new_windows = []
-        step_size = self.args.window_size // 2
-        window_size = step_size * 2
-
-        # motions : (motions, frames, joint DoF)
-        for motion in motions:
-            self.total_frame += motion.shape[0]
-            self.motion_length.append(motion.shape[0])
-            n_window = motion.shape[0] // step_size - \
-                1  # -1 : 마지막 window에 데이터가 전부 차지 않았다면 제거
-
-            for i in range(n_window):
-                begin = i * step_size
-                end = begin + window_size
-
-                # new: (64, 69)
-                new = motion[begin:end, :]
-                if self.args.rotation == 'quaternion':
-                    new = new.reshape(new.shape[0], -1, 3)
-                    rotations = new[:, :-1, :]
-                    rotations = Quaternions.from_euler(
-                        np.radians(rotations)).qs
-                    rotations = rotations.reshape(rotations.shape[0], -1)
-                    new = np.concatenate(
-                        (rotations, new[:, -1, :].reshape(new.shape[0], -1)), axis=1)
-
-                new = new[np.newaxis, ...]  # (1,64,91)
-                new_window = torch.tensor(new, dtype=torch.float32)
-                new_windows.append(new_window)
-
-        return torch.cat(new_windows)
-
     def subsample(self, motion):
         return motion[::2, :]
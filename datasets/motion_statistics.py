@@ -0,0 +1,69 @@
+import numpy as np
+
+""" mean / variance accumulated over many chunks, merged with Chan's parallel algorithm """
+
+
+class RunningStatistics:
+    def __init__(self, count=0, mean=None, m2=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+
+    @classmethod
+    def from_data(cls, data, axis):
+        """ statistics of one chunk, reduced over axis (dims are kept) """
+        data = np.asarray(data, dtype=np.float64)
+        count = int(np.prod([data.shape[a] for a in axis]))
+        if count == 0:
+            return cls()
+        mean = data.mean(axis=axis, keepdims=True)
+        m2 = ((data - mean) ** 2).sum(axis=axis, keepdims=True)
+        return cls(count, mean, m2)
+
+    def merge(self, other):
+        if other.count == 0:
+            return self
+        if self.count == 0:
+            self.count, self.mean, self.m2 = other.count, other.mean.copy(), other.m2.copy()
+            return self
+
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        self.mean = self.mean + delta * (other.count / count)
+        self.m2 = self.m2 + other.m2 + delta ** 2 * (self.count * other.count / count)
+        self.count = count
+        return self
+
+    def update(self, data, axis):
+        return self.merge(RunningStatistics.from_data(data, axis))
+
+    @classmethod
+    def merge_all(cls, statistics):
+        result = cls()
+        for s in statistics:
+            result.merge(s)
+        return result
+
+    @property
+    def var(self):
+        # unbiased, same as torch.var
+        return self.m2 / max(self.count - 1, 1)
+
+    @property
+    def std(self):
+        """ standard deviation used for normalization: small values are replaced by 1 """
+        std = self.var ** (1/2)
+        std[std < 1e-5] = 1
+        return std
+
+    def state_dict(self):
+        if self.count == 0:
+            return {'count': np.array(0)}
+        return {'count': np.array(self.count), 'mean': self.mean, 'm2': self.m2}
+
+    @classmethod
+    def from_state_dict(cls, state):
+        count = int(state['count'])
+        if count == 0:
+            return cls()
+        return cls(count, np.asarray(state['mean']), np.asarray(state['m2']))
@@ -0,0 +1,126 @@
+import os
+import sys
+import numpy as np
+
+"""
+Packed motion store of one character:
+    <name>_frames.npy : (total_frames, DoF) float32, every clip concatenated
+    <name>_index.npy  : (n_clip, 2) int64, offset and length of each clip in frames
+Both are plain .npy files opened with mmap_mode='r', so loading is instant and
+worker processes share the same pages instead of unpickling a copy each.
+
+    <name>_frames.<key>.npy : frames converted to the network representation <key> (rotation, root displacement),
+                             written once by the first MotionData that needs them, memory mapped as well
+
+python -m datasets.motion_store ./datasets/Mixamo/Aj.npy ...  converts the old pickled files
+"""
+
+
+def get_store_paths(file_path):
+    """ ./datasets/Mixamo/Aj.npy -> (./datasets/Mixamo/Aj_frames.npy, ./datasets/Mixamo/Aj_index.npy) """
+    base = os.path.splitext(file_path)[0]
+    return base + '_frames.npy', base + '_index.npy'
+
+
+def has_motion_store(file_path):
+    return all(os.path.exists(p) for p in get_store_paths(file_path))
+
+
+class MotionStore:
+    """ read-only sequence of clips, each clip is a (frames, DoF) view of the memory mapped array """
+    def __init__(self, file_path, mmap_mode='r'):
+        self.file_path = file_path
+        frames_path, index_path = get_store_paths(file_path)
+        self.frames = np.load(frames_path, mmap_mode=mmap_mode)
+        self.index = np.load(index_path)
+
+    def __len__(self):
+        return self.index.shape[0]
+
+    def __getitem__(self, item):
+        offset, length = self.index[item]
+        return self.frames[offset:offset + length]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @property
+    def lengths(self):
+        return self.index[:, 1]
+
+
+def get_converted_path(file_path, key):
+    """ ./datasets/Mixamo/Aj.npy, 'quaternion' -> ./datasets/Mixamo/Aj_frames.quaternion.npy """
+    return os.path.splitext(file_path)[0] + '_frames.{}.npy'.format(key)
+
+
+def load_converted_frames(store, key, convert):
+    """
+    memory mapped (total_frames, converted DoF) frames of a MotionStore, every clip run through
+    convert((frames, DoF) -> (frames, converted DoF)) once and saved; rewritten when the store is newer.
+    None if the converted file cannot be written
+    """
+    converted_path = get_converted_path(store.file_path, key)
+    _, index_path = get_store_paths(store.file_path)
+    if os.path.exists(converted_path) and os.path.getmtime(converted_path) >= os.path.getmtime(index_path):
+        frames = np.load(converted_path, mmap_mode='c')
+        if frames.shape[0] == store.frames.shape[0]:
+            return frames
+
+    try:
+        tmp_path = converted_path + '.tmp.npy'
+        frames = None
+        for (offset, length), clip in zip(store.index, store):
+            clip = np.asarray(convert(clip), dtype=np.float32)
+            if frames is None:
+                frames = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32,
+                                                   shape=(store.frames.shape[0], clip.shape[1]))
+            frames[offset:offset + length] = clip
+        if frames is None:
+            return None
+        frames.flush()
+        del frames
+        os.replace(tmp_path, converted_path)
+    except OSError:
+        return None
+    return np.load(converted_path, mmap_mode='c')
+
+
+def write_motion_store(file_path, motions):
+    """ motions: list of (frames, DoF) arrays """
+    frames_path, index_path = get_store_paths(file_path)
+    lengths = np.array([motion.shape[0] for motion in motions], dtype=np.int64)
+    offsets = np.concatenate(([0], np.cumsum(lengths)[:-1])).astype(np.int64)
+    index = np.stack((offsets, lengths), axis=1) if len(motions) > 0 else np.zeros((0, 2), dtype=np.int64)
+
+    if len(motions) > 0:
+        frames = np.concatenate([np.asarray(motion, dtype=np.float32) for motion in motions])
+    else:
+        frames = np.zeros((0, 0), dtype=np.float32)
+
+    # index is written last: a store is only complete once both files exist
+    for path, array in ((frames_path, frames), (index_path, index)):
+        tmp_path = path + '.tmp.npy'
+        np.save(tmp_path, array)
+        os.replace(tmp_path, path)
+
+
+def load_motions(file_path):
+    """ clips of a character: from the motion store if there is one, otherwise from the pickled .npy """
+    if has_motion_store(file_path):
+        return MotionStore(file_path)
+    return list(np.load(file_path, allow_pickle=True))
+
+
+def convert_npy(file_path):
+    """ write the motion store of a pickled list of clips """
+    motions = list(np.load(file_path, allow_pickle=True))
+    write_motion_store(file_path, motions)
+    return len(motions)
+
+
+if __name__ == '__main__':
+    for path in sys.argv[1:]:
+        n_clip = convert_npy(path)
+        print('{}: {} clips -> {}'.format(path, n_clip, ', '.join(get_store_paths(path))))
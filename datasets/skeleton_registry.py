@@ -0,0 +1,131 @@
+import os
+import re
+import glob
+import hashlib
+import numpy as np
+from option_parser import get_std_bvh
+from models.skeleton import build_edge_topology, build_joint_topology
+
+"""
+Skeleton metadata of each character, parsed once per process from its std bvh.
+A compact binary cache keyed by the hash of the std bvh lets later runs skip parsing.
+"""
+
+# bump when BVH parsing or the cached arrays change: entries of another version are parsed again
+CACHE_VERSION = 1
+
+_skeletons = {}
+_writers = {}
+
+
+class CharacterSkeleton:
+    """ static skeleton information of BVH_file (topology, offset, edges, ee ids, height, writer tables) """
+    def __init__(self, names, topology, offset, ee_id, height):
+        self.names = list(names)
+        self.topology = tuple(int(p) for p in topology)
+        self.offset = np.asarray(offset)
+        self.ee_id = [int(i) for i in ee_id]
+        self.height = float(height)
+
+        # edges : (parent idx, index, offset)
+        self.edges = build_edge_topology(self.topology, self.offset)
+        # tables used by BVH_writer
+        self.parent, self.writer_offset, self.writer_names, self.edge2joint = build_joint_topology(self.edges, self.names)
+
+    @classmethod
+    def from_bvh_file(cls, file):
+        return cls(file.names, file.topology, file.offset, file.get_ee_id(), file.get_height())
+
+    def get_ee_id(self):
+        return self.ee_id
+
+    def get_height(self):
+        return self.height
+
+    def save(self, path):
+        tmp_path = path + '.tmp.npz'
+        np.savez(tmp_path, version=np.array(CACHE_VERSION), names=np.array(self.names),
+                 topology=np.array(self.topology, dtype=np.int64), offset=self.offset,
+                 ee_id=np.array(self.ee_id, dtype=np.int64), height=np.array(self.height))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        with np.load(path, allow_pickle=False) as data:
+            check_cache_version(data)
+            return cls(data['names'].tolist(), data['topology'], data['offset'], data['ee_id'], data['height'])
+
+
+def file_hash(file_path):
+    with open(file_path, 'rb') as file:
+        return hashlib.sha1(file.read()).hexdigest()
+
+
+def get_cache_path(file_path, digest, kind):
+    """ <dir>/cache/<kind>/<name>.<digest>.npz: every kind of cache ('clips', 'skeletons') has its own directory """
+    cache_dir = os.path.join(os.path.dirname(file_path), 'cache', kind)
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    return os.path.join(cache_dir, '{}.{}.npz'.format(name, digest[:16]))
+
+
+def check_cache_version(data):
+    """ data: opened npz cache entry, ValueError (handled like a broken entry) if written by another version """
+    if 'version' not in data or int(data['version']) != CACHE_VERSION:
+        raise ValueError('cache entry of another version')
+
+
+def remove_stale_cache(file_path, cache_path):
+    """ delete the cache entries of file_path for other contents (hashes) than the one of cache_path, in its kind only """
+    cache_dir = os.path.dirname(cache_path)
+    name = os.path.splitext(os.path.basename(file_path))[0]
+    pattern = re.compile(re.escape(name) + r'\.[0-9a-f]{16}\.npz')
+    for path in glob.glob(os.path.join(glob.escape(cache_dir), glob.escape(name) + '.*.npz')):
+        if path != cache_path and pattern.fullmatch(os.path.basename(path)):
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+
+def load_skeleton(file_path):
+    """ load from the binary cache if the bvh is unchanged, otherwise parse it and write the cache """
+    digest = file_hash(file_path)
+    cache_path = get_cache_path(file_path, digest, 'skeletons')
+    if os.path.exists(cache_path):
+        try:
+            return CharacterSkeleton.load(cache_path)
+        except (OSError, KeyError, ValueError):
+            pass
+
+    from datasets.bvh_parser import BVH_file
+    skeleton = CharacterSkeleton.from_bvh_file(BVH_file(file_path))
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        skeleton.save(cache_path)
+        remove_stale_cache(file_path, cache_path)
+    except OSError:
+        pass
+    return skeleton
+
+
+def get_skeleton_path(character=None, file_path=None):
+    if file_path is None:
+        file_path = get_std_bvh(dataset=character)
+    return os.path.abspath(file_path)
+
+
+def get_skeleton(character=None, file_path=None):
+    """ CharacterSkeleton of a character (std bvh) or of a bvh file, memoized for the whole process """
+    key = get_skeleton_path(character, file_path)
+    if key not in _skeletons:
+        _skeletons[key] = load_skeleton(key)
+    return _skeletons[key]
+
+
+def get_bvh_writer(character=None, file_path=None):
+    """ BVH_writer built from the memoized skeleton tables """
+    from datasets.bvh_writer import BVH_writer
+    key = get_skeleton_path(character, file_path)
+    if key not in _writers:
+        _writers[key] = BVH_writer.from_skeleton(get_skeleton(file_path=key))
+    return _writers[key]
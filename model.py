@@ -6,6 +6,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import numpy as np
 import os
+from functools import lru_cache
 from wandb import set_trace
 # import option_parser
 from datasets import get_character_names, create_dataset
@@ -29,18 +30,26 @@ class ScaledDotProductAttention(nn.Module):
         # d_head (64) : dim of key vector
         self.d_head = args.d_head
         self.scale = 1 / (self.d_head ** 0.5)
+        # fused: F.scaled_dot_product_attention when the attention map is not needed, explicit: always softmax(QK^T)V
+        self.backend = getattr(args, 'attention_backend', 'fused')
         # self.V_index = 0
 
-    def forward(self, Q, K, V):
+    def forward(self, Q, K, V, need_weights=True):
         # Q,K,V: (bs, n_head, window, DoF)
 
+        if not need_weights and self.backend == 'fused':
+            # fused kernel, the (window, window) probability matrix is never materialized
+            # default scale of the kernel is 1 / sqrt(d_head), same as self.scale
+            context = F.scaled_dot_product_attention(Q, K, V)
+            return context, None
+
         # (bs, n_head, window, window)
         scores = torch.matmul(Q, K.transpose(-1, -2)).mul_(self.scale)
 
         # bs = scores.size(0)
 
         # Softmax on last dim
-        attn_prob = nn.Softmax(dim=-1)(scores)
+        attn_prob = F.softmax(scores, dim=-1)
 
         context = torch.matmul(attn_prob, V)
 
@@ -77,7 +86,7 @@ class MultiHeadAttention(nn.Module):
         self.scaled_dot_attn = ScaledDotProductAttention(args)
         self.linear = nn.Linear(self.n_head * self.d_head, self.input_dim)
 
-    def forward(self, Q, K, V):
+    def forward(self, Q, K, V, need_weights=True):
         # Q,K,V:(bs, window, DoF)
         batch_size = Q.size(0)
 
@@ -92,7 +101,7 @@ class MultiHeadAttention(nn.Module):
 
         # Attentinon 계산
         # context: (bs, n_head, window, d_head)
-        context, attn_prob = self.scaled_dot_attn(q_s, k_s, v_s)
+        context, attn_prob = self.scaled_dot_attn(q_s, k_s, v_s, need_weights)
 
         # (bs, n_head, window, d_head) -> (bs, window, n_head * d_head)
         context = context.transpose(1, 2).contiguous().view(
@@ -152,9 +161,9 @@ class EncoderLayer(nn.Module):
         self.layer_norm2 = nn.LayerNorm(
             self.input_dim, eps=self.layer_norm_epsilon)
 
-    def forward(self, inputs):
+    def forward(self, inputs, need_weights=True):
         att_outputs, attn_prob, context = self.self_attn(
-            inputs, inputs, inputs)
+            inputs, inputs, inputs, need_weights)
         att_outputs = self.layer_norm1(inputs + att_outputs)
 
         ffn_outputs = self.pos_ffn(att_outputs)
@@ -181,14 +190,14 @@ class DecoderLayer(nn.Module):
         self.layer_norm3 = nn.LayerNorm(
             self.input_dim, eps=self.args.layer_norm_epsilon)
 
-    def forward(self, dec_inputs, enc_outputs):
+    def forward(self, dec_inputs, enc_outputs, need_weights=True):
 
         self_att_outputs, self_attn_prob, _ = self.self_attn(
-            dec_inputs, dec_inputs, dec_inputs)  # Q, K, V, attn
+            dec_inputs, dec_inputs, dec_inputs, need_weights)  # Q, K, V, attn
         self_att_outputs = self.layer_norm1(dec_inputs + self_att_outputs)
 
         dec_enc_att_outputs, dec_enc_attn_prob, _ = self.dec_enc_attn(
-            self_att_outputs, enc_outputs, enc_outputs)
+            self_att_outputs, enc_outputs, enc_outputs, need_weights)
         dec_enc_att_outputs = self.layer_norm2(
             self_att_outputs + dec_enc_att_outputs)
 
@@ -203,15 +212,11 @@ class DecoderLayer(nn.Module):
 
 
 def get_sinusoid_encoding_table(n_seq, d_hidn):  # seq의 길이,embedding 차원
-    # 포지션을 angle로 나타냄
-    def cal_angle(position, i_hidn):
-        return position / np.power(10000, 2 * (i_hidn // 2) / d_hidn)
+    # 포지션을 angle로 나타냄: position / 10000^(2 * (i_hidn // 2) / d_hidn)
+    positions = np.arange(n_seq, dtype=np.float64)[:, np.newaxis]
+    i_hidn = np.arange(d_hidn)
+    sinusoid_table = positions / np.power(10000, 2 * (i_hidn // 2) / d_hidn)
 
-    def get_posi_ang_vec(position):
-        return [cal_angle(position, i_hidn) for i_hidn in range(d_hidn)]
-
-    sinusoid_table = np.array([get_posi_ang_vec(i_seq)
-                              for i_seq in range(n_seq)])
     # (bs, posiiton value)
     sinusoid_table[:, 0::2] = np.sin(sinusoid_table[:, 0::2])
     sinusoid_table[:, 1::2] = np.cos(sinusoid_table[:, 1::2])
@@ -220,6 +225,26 @@ def get_sinusoid_encoding_table(n_seq, d_hidn):  # seq의 길이,embedding 차
     return sinusoid_table
 
 
+@lru_cache(maxsize=None)
+def get_sinusoid_encoding_tensor(n_seq, d_hidn):
+    # computed once per (n_seq, d_hidn) and shared, callers copy it
+    return torch.FloatTensor(get_sinusoid_encoding_table(n_seq, d_hidn))
+
+
+class PositionalEncoding(nn.Embedding):
+    """
+    Frozen sinusoid table, row 0 is unused (positions start at 1).
+    Kept as an nn.Embedding so checkpoints keep the pos_emb.weight entry.
+    """
+    def __init__(self, n_seq, d_hidn):
+        super().__init__(n_seq, d_hidn, _weight=get_sinusoid_encoding_tensor(n_seq, d_hidn).clone())
+        self.weight.requires_grad = False
+
+    def get(self, length):
+        # (length, d_hidn) view of positions 1..length, broadcast over the batch
+        return self.weight[1:length + 1]
+
+
 """ Encoder & Decoder """
 class Encoder(nn.Module):
     def __init__(self, args, offset):
@@ -237,10 +262,7 @@ class Encoder(nn.Module):
         self.input_embedding = nn.Linear(self.input_size, self.embedding_dim)
 
         # Positional Embedding
-        self.sinusoid_table = torch.FloatTensor(get_sinusoid_encoding_table(
-            self.args.window_size + 1, self.embedding_dim))
-        self.pos_emb = nn.Embedding.from_pretrained(
-            self.sinusoid_table, freeze=True)
+        self.pos_emb = PositionalEncoding(self.args.window_size + 1, self.embedding_dim)
 
         """ Layer """
         self.fc1 = nn.Linear(self.embedding_dim, self.embedding_dim)
@@ -249,7 +271,7 @@ class Encoder(nn.Module):
         self.projection = nn.Linear(self.embedding_dim, self.embedding_dim)
 
     # (bs, length of frames, joints): (4, 91, 64) # 4개의 bs 에 대해서 모두 동일한 character index을 가지고 있다.
-    def forward(self, input_character, inputs):
+    def forward(self, input_character, inputs, return_attention=False):
         """ option for add_offset """
         if self.args.add_offset:
             offset = self.offset[input_character]
@@ -259,12 +281,8 @@ class Encoder(nn.Module):
 
         """ Get Position and Embedding """
         if self.args.data_encoding:
-            # (128) -> (1,128,1) -> (16,128)
-            positions = torch.arange(inputs.size(1), device=inputs.device, dtype=torch.long).unsqueeze(
-                0).expand(inputs.size(0), inputs.size(1)).contiguous() + 1
-
-            # (16,128,256)
-            position_encoding = self.pos_emb(positions)
+            # (128,256): positions 1..128, broadcast to (16,128,256)
+            position_encoding = self.pos_emb.get(inputs.size(1))
 
             input_embedding = self.input_embedding(inputs)
 
@@ -275,8 +293,9 @@ class Encoder(nn.Module):
         """ 연산 """
         attn_probs = []
         for layer in self.layers:
-            outputs, attn_prob, context = layer(outputs)
-            attn_probs.append(attn_prob)
+            outputs, attn_prob, context = layer(outputs, return_attention)
+            if return_attention:
+                attn_probs.append(attn_prob)
 
         outputs = self.projection(outputs)
 
@@ -328,15 +347,12 @@ class Decoder(nn.Module):
         self.input_embedding = nn.Linear(
             self.embedding_dim, self.embedding_dim)
         # Positional Embedding
-        self.sinusoid_table = torch.FloatTensor(get_sinusoid_encoding_table(
-            self.args.window_size + 1, self.embedding_dim))
-        self.pos_emb = nn.Embedding.from_pretrained(
-            self.sinusoid_table, freeze=True)
+        self.pos_emb = PositionalEncoding(self.args.window_size + 1, self.embedding_dim)
 
         self.de_embedding = nn.Linear(self.embedding_dim, self.output_size)
 
     # (bs, DoF, d_hidn)
-    def forward(self, output_character, dec_inputs, enc_inputs, enc_outputs):
+    def forward(self, output_character, dec_inputs, enc_inputs, enc_outputs, return_attention=False):
 
         if self.args.add_offset:
             offset = self.offset[output_character]
@@ -353,9 +369,10 @@ class Decoder(nn.Module):
         self_attn_probs, dec_enc_attn_probs = [], []
         for layer in self.layers:
             dec_outputs, self_attn_prob, dec_enc_attn_prob = layer(
-                dec_outputs, enc_outputs)
-            self_attn_probs.append(self_attn_prob)
-            dec_enc_attn_probs.append(dec_enc_attn_prob)
+                dec_outputs, enc_outputs, return_attention)
+            if return_attention:
+                self_attn_probs.append(self_attn_prob)
+                dec_enc_attn_probs.append(dec_enc_attn_prob)
 
         dec_outputs = self.de_embedding(dec_outputs)
 
@@ -372,18 +389,19 @@ class Transformer(nn.Module):
         self.projection_net = ProjectionNet(args)
         self.decoder = Decoder(args, offsets[1])
 
-    def forward(self, input_character, output_character, enc_inputs, dec_inputs):
+    def forward(self, input_character, output_character, enc_inputs, dec_inputs, return_attention=False):
         # input: (bs, window, DoF), output: (bs, window, DoF)
+        # return_attention=False: attention maps are not computed (fused attention), the lists are empty
 
         enc_outputs, enc_self_attn_probs, context = self.encoder(
-            input_character, enc_inputs)
+            input_character, enc_inputs, return_attention)
 
         if self.args.swap_dim == 1:
             enc_outputs = self.projection_net(enc_outputs)
 
         # input: (bs, window, DoF), output: (bs, window, DoF)
         dec_outputs, dec_self_attn_probs, dec_enc_attn_probs = self.decoder(
-            output_character, dec_inputs, enc_inputs, enc_outputs)
+            output_character, dec_inputs, enc_inputs, enc_outputs, return_attention)
 
         return dec_outputs, enc_self_attn_probs, dec_self_attn_probs, dec_enc_attn_probs
 
@@ -404,9 +422,10 @@ class MotionGenerator(nn.Module):
         self.projection = nn.Linear(self.output_size, self.output_size)
 
     """ Transofrmer """
-    def forward(self, input_character, output_character, enc_inputs, dec_inputs):
+    def forward(self, input_character, output_character, enc_inputs, dec_inputs, return_attention=False):
+        # attention maps of every layer are kept only if requested (return_attention=True), otherwise the lists are empty
         dec_outputs, enc_self_attn_probs, dec_self_attn_probs, dec_enc_attn_probs = self.transformer(
-            input_character, output_character, enc_inputs, dec_inputs)
+            input_character, output_character, enc_inputs, dec_inputs, return_attention)
 
         output = self.projection(dec_outputs)
 
@@ -441,12 +460,21 @@ class Discriminator(nn.Module):
         # self.activation = nn.LeakyReLU(negative_slope=0.2)
 
         """ layers """
-        self.transformer = Transformer(args, offsets)
-        self.projection = nn.Linear(self.input_dim, self.input_dim)
+        self.light = getattr(args, 'light_discriminator', 0)
+        if self.light:
+            # encoder only with a linear head: no projection net and decoder
+            self.encoder = Encoder(args, offsets[0])
+            self.projection = nn.Linear(args.embedding_dim, self.input_dim)
+        else:
+            self.transformer = Transformer(args, offsets)
+            self.projection = nn.Linear(self.input_dim, self.input_dim)
 
     def forward(self, input_character, output_character, enc_inputs, dec_inputs):
-        output, _, _, _ = self.transformer(
-            input_character, output_character, enc_inputs, dec_inputs)
+        if self.light:
+            output, _, _ = self.encoder(input_character, enc_inputs)
+        else:
+            output, _, _, _ = self.transformer(
+                input_character, output_character, enc_inputs, dec_inputs, return_attention=False)
 
         output = self.projection(output)
 
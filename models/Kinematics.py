@@ -2,6 +2,73 @@ import torch
 import torch.nn as nn
 import numpy as np
 import math
+from functools import lru_cache
+from typing import List
+from models.rotation import axis_to_matrix, euler_to_matrix, quaternion_to_matrix
+
+
+""" depth-level forward kinematics """
+
+
+@lru_cache(maxsize=None)
+def get_fk_levels(topology, device='cpu'):
+    """
+    topology: tuple of parent indices (-1 for the root, every parent before its children), cached per topology and device
+    -> joints of each depth, position of their parents in the previous depth, position of every joint in the concatenated levels
+    """
+    depth = [0] * len(topology)
+    for i, pi in enumerate(topology):
+        if pi == -1:
+            assert i == 0
+            continue
+        assert pi < i, 'parents must come before their children'
+        depth[i] = depth[pi] + 1
+
+    levels = [[i for i in range(len(topology)) if depth[i] == d] for d in range(max(depth) + 1)]
+    parents = [[]] + [[levels[d - 1].index(topology[i]) for i in levels[d]] for d in range(1, len(levels))]
+    order = [i for level in levels for i in level]
+    inverse = [order.index(i) for i in range(len(topology))]
+
+    as_tensor = lambda index: torch.tensor(index, dtype=torch.long, device=device)
+    return [as_tensor(level) for level in levels], [as_tensor(parent) for parent in parents], as_tensor(inverse)
+
+
+def forward_levels(transform: torch.Tensor, position: torch.Tensor, offset: torch.Tensor,
+                   levels: List[torch.Tensor], parents: List[torch.Tensor], inverse: torch.Tensor, world: bool,
+                   parent_transform: bool = False):
+    """
+    same result as the joint loops of ForwardKinematics / InverseKinematics.forward, all the joints of one depth in one batched matmul
+    transform: (..., Time, Joint_num, 3, 3) local, position: (..., Time, 3), offset: (..., 1, Joint_num, 3, 1)
+    parent_transform: offsets rotated by the global transform of the parent (InverseKinematics) instead of the joint's own
+    """
+    global_transform = transform.index_select(-3, levels[0])
+    results = [position.unsqueeze(-2)]
+    for d in range(1, len(levels)):
+        parent_global = global_transform.index_select(-3, parents[d])
+        global_transform = torch.matmul(parent_global, transform.index_select(-3, levels[d]))
+        result = torch.matmul(parent_global if parent_transform else global_transform,
+                              offset.index_select(-3, levels[d])).squeeze(-1)
+        if world:
+            result = result + results[d - 1].index_select(-2, parents[d])
+        results.append(result)
+    return torch.cat(results, dim=-2).index_select(-2, inverse)
+
+
+_forward_levels_compiled = {}
+
+
+def get_forward_levels(backend):
+    """ levels: eager, script: torch.jit.script, compile: torch.compile (eager if not available) """
+    if backend == 'levels':
+        return forward_levels
+    if backend not in _forward_levels_compiled:
+        if backend == 'script':
+            _forward_levels_compiled[backend] = torch.jit.script(forward_levels)
+        elif backend == 'compile':
+            _forward_levels_compiled[backend] = torch.compile(forward_levels, dynamic=True) if hasattr(torch, 'compile') else forward_levels
+        else:
+            raise Exception('Unknown fk backend: {}'.format(backend))
+    return _forward_levels_compiled[backend]
 
 
 class ForwardKinematics:
@@ -16,6 +83,10 @@ class ForwardKinematics:
         self.pos_repr = '3d' # args.pos_repr
         self.quater = args.rotation == 'quaternion'
 
+        # loop: one joint after the other, levels / script / compile: one batched matmul per depth
+        self.backend = getattr(args, 'fk_backend', 'levels')
+        self.topology_key = tuple(self.topology)
+
     def forward_from_raw(self, raw, offset, world=None, quater=None):
         if world is None: world = self.world
         if quater is None: quater = self.quater
@@ -36,8 +107,7 @@ class ForwardKinematics:
         new_shape[2] = 1
         rotation_final = identity.repeat(new_shape)
 
-        for i, j in enumerate(self.rotation_map):
-            rotation_final[:, j, :, :] = rotation[:, i, :, :]
+        rotation_final[:, self.rotation_map, :, :] = rotation.to(rotation_final.dtype)
 
         return self.forward(rotation_final, position, offset, world=world, quater=quater)
 
@@ -53,7 +123,6 @@ class ForwardKinematics:
 
         rotation = rotation.permute(0, 3, 1, 2) # (16,22,4,128) -> 16,128,23,4
         position = position.permute(0, 2, 1) # (16,3,128) -> 16,128,3
-        result = torch.empty(rotation.shape[:-1] + (3, ), device=position.device) # (16,128,23,2)
 
         norm = torch.norm(rotation, dim=-1, keepdim=True) # 16,128,23,4 -> 16,128,23,1
         #norm[norm < 1e-10] = 1
@@ -70,6 +139,13 @@ class ForwardKinematics:
 
         offset = offset.reshape((-1, 1, offset.shape[-2], offset.shape[-1], 1))
 
+        if self.backend != 'loop':
+            levels, parents, inverse = get_fk_levels(self.topology_key, transform.device)
+            forward = get_forward_levels(self.backend)
+            result = forward(transform, position, offset, levels, parents, inverse, bool(world))
+            return result.to(torch.get_default_dtype())
+
+        result = torch.empty(rotation.shape[:-1] + (3, ), device=position.device) # (16,128,23,2)
         result[..., 0, :] = position
 
         for i, pi in enumerate(self.topology):
@@ -84,6 +160,12 @@ class ForwardKinematics:
 
     def from_local_to_world(self, res: torch.Tensor):
         res = res.clone()
+        if self.backend != 'loop':
+            # depth by depth, the children of the root stay local
+            for level in get_fk_levels(self.topology_key)[0][2:]:
+                level = level.tolist()
+                res[..., level, :] += res[..., [self.topology[i] for i in level], :]
+            return res
         for i, pi in enumerate(self.topology):
             if pi == 0 or pi == -1:
                 continue
@@ -92,73 +174,26 @@ class ForwardKinematics:
 
     @staticmethod
     def transform_from_euler(rotation, order):
+        # rotation: (..., 3) in degrees
         rotation = rotation / 180 * math.pi
-        transform = torch.matmul(ForwardKinematics.transform_from_axis(rotation[..., 1], order[1]),
-                                 ForwardKinematics.transform_from_axis(rotation[..., 2], order[2]))
-        transform = torch.matmul(ForwardKinematics.transform_from_axis(rotation[..., 0], order[0]), transform)
-        return transform
+        return euler_to_matrix(rotation, order)
 
     @staticmethod
     def transform_from_axis(euler, axis):
-        transform = torch.empty(euler.shape[0:3] + (3, 3), device=euler.device)
-        cos = torch.cos(euler)
-        sin = torch.sin(euler)
-        cord = ord(axis) - ord('x')
-
-        transform[..., cord, :] = transform[..., :, cord] = 0
-        transform[..., cord, cord] = 1
-
-        if axis == 'x':
-            transform[..., 1, 1] = transform[..., 2, 2] = cos
-            transform[..., 1, 2] = -sin
-            transform[..., 2, 1] = sin
-        if axis == 'y':
-            transform[..., 0, 0] = transform[..., 2, 2] = cos
-            transform[..., 0, 2] = sin
-            transform[..., 2, 0] = -sin
-        if axis == 'z':
-            transform[..., 0, 0] = transform[..., 1, 1] = cos
-            transform[..., 0, 1] = -sin
-            transform[..., 1, 0] = sin
-
-        return transform
+        return axis_to_matrix(euler, axis)
 
     @staticmethod
     def transform_from_quaternion(quater: torch.Tensor):
-        qw = quater[..., 0]
-        qx = quater[..., 1]
-        qy = quater[..., 2]
-        qz = quater[..., 3]
-
-        x2 = qx + qx
-        y2 = qy + qy
-        z2 = qz + qz
-        xx = qx * x2
-        yy = qy * y2
-        wx = qw * x2
-        xy = qx * y2
-        yz = qy * z2
-        wy = qw * y2
-        xz = qx * z2
-        zz = qz * z2
-        wz = qw * z2
-
-        m = torch.empty(quater.shape[:-1] + (3, 3), device=quater.device)
-        m[..., 0, 0] = 1.0 - (yy + zz)
-        m[..., 0, 1] = xy - wz
-        m[..., 0, 2] = xz + wy
-        m[..., 1, 0] = xy + wz
-        m[..., 1, 1] = 1.0 - (xx + zz)
-        m[..., 1, 2] = yz - wx
-        m[..., 2, 0] = xz - wy
-        m[..., 2, 1] = yz + wx
-        m[..., 2, 2] = 1.0 - (xx + yy)
-
-        return m
+        return quaternion_to_matrix(quater)
 
 
 class InverseKinematics:
-    def __init__(self, rotations: torch.Tensor, positions: torch.Tensor, offset, parents, constrains):
+    """
+    rotations: ([clip,] T, J, 4) quaternions, positions: ([clip,] T, 3) root, constrains: ([clip,] T, J, 3) global positions
+    With a clip dimension the loss is the sum of the per-clip losses: Adam updates every parameter element-wise,
+    so each clip follows the same trajectory as if it was solved alone.
+    """
+    def __init__(self, rotations: torch.Tensor, positions: torch.Tensor, offset, parents, constrains, lr=1e-3):
         self.rotations = rotations
         self.rotations.requires_grad_(True)
         self.position = positions
@@ -168,16 +203,23 @@ class InverseKinematics:
         self.offset = offset
         self.constrains = constrains
 
-        self.optimizer = torch.optim.Adam([self.position, self.rotations], lr=1e-3, betas=(0.9, 0.999))
+        self.optimizer = torch.optim.Adam([self.position, self.rotations], lr=lr, betas=(0.9, 0.999))
         self.crit = nn.MSELoss()
 
+    def clip_losses(self, glb):
+        """ MSE of every clip: () without a clip dimension, (clip, ) otherwise """
+        loss = nn.functional.mse_loss(glb, self.constrains, reduction='none')
+        return loss.reshape(loss.shape[:loss.dim() - 3] + (-1, )).mean(dim=-1)
+
     def step(self):
         self.optimizer.zero_grad()
         glb = self.forward(self.rotations, self.position, self.offset, order='', quater=True, world=True)
-        loss = self.crit(glb, self.constrains)
+        losses = self.clip_losses(glb)
+        loss = losses.sum()
         loss.backward()
         self.optimizer.step()
         self.glb = glb
+        self.losses = losses.detach()
         return loss.item()
 
     def tloss(self, time):
@@ -188,10 +230,10 @@ class InverseKinematics:
         return np.array(res)
 
     '''
-        rotation should have shape batch_size * Joint_num * (3/4) * Time
-        position should have shape batch_size * 3 * Time
-        offset should have shape batch_size * Joint_num * 3
-        output have shape batch_size * Time * Joint_num * 3
+        rotation should have shape ([clip,] T, J, 4)
+        position should have shape ([clip,] T, 3)
+        offset should have shape ([clip,] J, 3)
+        output have shape ([clip,] T, J, 3)
     '''
 
     def forward(self, rotation: torch.Tensor, position: torch.Tensor, offset: torch.Tensor, order='xyz', quater=False,
@@ -202,8 +244,6 @@ class InverseKinematics:
         rotation = rotation.permute(0, 3, 1, 2)
         position = position.permute(0, 2, 1)
         '''
-        result = torch.empty(rotation.shape[:-1] + (3,), device=position.device)
-
         norm = torch.norm(rotation, dim=-1, keepdim=True)
         rotation = rotation / norm
 
@@ -212,81 +252,23 @@ class InverseKinematics:
         else:
             transform = self.transform_from_euler(rotation, order)
 
-        offset = offset.reshape((-1, 1, offset.shape[-2], offset.shape[-1], 1))
+        # (J, 3) -> (J, 3, 1), (clip, J, 3) -> (clip, 1, J, 3, 1)
+        offset = offset.unsqueeze(-1)
+        if offset.dim() == 4:
+            offset = offset.unsqueeze(1)
 
-        result[..., 0, :] = position
-        for i, pi in enumerate(self.parents):
-            if pi == -1:
-                assert i == 0
-                continue
-
-            result[..., i, :] = torch.matmul(transform[..., pi, :, :], offset[..., i, :, :]).squeeze()
-            transform[..., i, :, :] = torch.matmul(transform[..., pi, :, :], transform[..., i, :, :])
-            if world: result[..., i, :] += result[..., pi, :]
-        return result
+        # one batched matmul per depth, out of place so that the loss can be backpropagated
+        levels, parents, inverse = get_fk_levels(tuple(self.parents), transform.device)
+        return forward_levels(transform, position, offset, levels, parents, inverse, bool(world), True)
 
     @staticmethod
     def transform_from_euler(rotation, order):
-        rotation = rotation / 180 * math.pi
-        transform = torch.matmul(ForwardKinematics.transform_from_axis(rotation[..., 1], order[1]),
-                                 ForwardKinematics.transform_from_axis(rotation[..., 2], order[2]))
-        transform = torch.matmul(ForwardKinematics.transform_from_axis(rotation[..., 0], order[0]), transform)
-        return transform
+        return ForwardKinematics.transform_from_euler(rotation, order)
 
     @staticmethod
     def transform_from_axis(euler, axis):
-        transform = torch.empty(euler.shape[0:3] + (3, 3), device=euler.device)
-        cos = torch.cos(euler)
-        sin = torch.sin(euler)
-        cord = ord(axis) - ord('x')
-
-        transform[..., cord, :] = transform[..., :, cord] = 0
-        transform[..., cord, cord] = 1
-
-        if axis == 'x':
-            transform[..., 1, 1] = transform[..., 2, 2] = cos
-            transform[..., 1, 2] = -sin
-            transform[..., 2, 1] = sin
-        if axis == 'y':
-            transform[..., 0, 0] = transform[..., 2, 2] = cos
-            transform[..., 0, 2] = sin
-            transform[..., 2, 0] = -sin
-        if axis == 'z':
-            transform[..., 0, 0] = transform[..., 1, 1] = cos
-            transform[..., 0, 1] = -sin
-            transform[..., 1, 0] = sin
-
-        return transform
+        return axis_to_matrix(euler, axis)
 
     @staticmethod
     def transform_from_quaternion(quater: torch.Tensor):
-        qw = quater[..., 0]
-        qx = quater[..., 1]
-        qy = quater[..., 2]
-        qz = quater[..., 3]
-
-        x2 = qx + qx
-        y2 = qy + qy
-        z2 = qz + qz
-        xx = qx * x2
-        yy = qy * y2
-        wx = qw * x2
-        xy = qx * y2
-        yz = qy * z2
-        wy = qw * y2
-        xz = qx * z2
-        zz = qz * z2
-        wz = qw * z2
-
-        m = torch.empty(quater.shape[:-1] + (3, 3), device=quater.device)
-        m[..., 0, 0] = 1.0 - (yy + zz)
-        m[..., 0, 1] = xy - wz
-        m[..., 0, 2] = xz + wy
-        m[..., 1, 0] = xy + wz
-        m[..., 1, 1] = 1.0 - (xx + zz)
-        m[..., 1, 2] = yz - wx
-        m[..., 2, 0] = xz - wy
-        m[..., 2, 1] = yz + wx
-        m[..., 2, 2] = 1.0 - (xx + yy)
-
-        return m
+        return quaternion_to_matrix(quater)
@@ -0,0 +1,113 @@
+import torch
+
+""" rotation conversions on torch tensors, batched over all leading dims (same conventions as utils/Quaternions.py and models/Kinematics.py) """
+
+
+_axis_index = {'x': 0, 'y': 1, 'z': 2}
+
+
+def quaternion_from_angle_axis(angles, axis):
+    """ angles: (...), axis: 'x', 'y' or 'z' -> (..., 4) in (w, x, y, z) """
+    half = angles / 2.0
+    quater = torch.zeros(angles.shape + (4,), dtype=angles.dtype, device=angles.device)
+    quater[..., 0] = torch.cos(half)
+    quater[..., 1 + _axis_index[axis]] = torch.sin(half)
+    return quater
+
+
+def quaternion_multiply(q, r):
+    """ Quaternions(q) * Quaternions(r) """
+    q0, q1, q2, q3 = q.unbind(-1)
+    r0, r1, r2, r3 = r.unbind(-1)
+    return torch.stack((r0 * q0 - r1 * q1 - r2 * q2 - r3 * q3,
+                        r0 * q1 + r1 * q0 - r2 * q3 + r3 * q2,
+                        r0 * q2 + r1 * q3 + r2 * q0 - r3 * q1,
+                        r0 * q3 - r1 * q2 + r2 * q1 + r3 * q0), dim=-1)
+
+
+def euler_to_quaternion(euler, order='xyz', world=False):
+    """ euler: (..., 3) in radians -> (..., 4), same as Quaternions.from_euler(euler, order, world).qs """
+    q0 = quaternion_from_angle_axis(euler[..., 0], order[0])
+    q1 = quaternion_from_angle_axis(euler[..., 1], order[1])
+    q2 = quaternion_from_angle_axis(euler[..., 2], order[2])
+    if world:
+        return quaternion_multiply(q2, quaternion_multiply(q1, q0))
+    return quaternion_multiply(q0, quaternion_multiply(q1, q2))
+
+
+""" rotation matrices (..., 3, 3), every element built once and assembled with a single stack """
+
+
+def _stack_matrix(elements):
+    """ 9 tensors of shape (...) in row major order -> (..., 3, 3) """
+    matrix = torch.stack(elements, dim=-1)
+    return matrix.reshape(matrix.shape[:-1] + (3, 3))
+
+
+def axis_to_matrix(angles, axis):
+    """ angles: (...) in radians, axis: 'x', 'y' or 'z' -> (..., 3, 3), same as ForwardKinematics.transform_from_axis """
+    cos, sin = torch.cos(angles), torch.sin(angles)
+    one, zero = torch.ones_like(angles), torch.zeros_like(angles)
+    if axis == 'x':
+        return _stack_matrix((one, zero, zero, zero, cos, -sin, zero, sin, cos))
+    if axis == 'y':
+        return _stack_matrix((cos, zero, sin, zero, one, zero, -sin, zero, cos))
+    if axis == 'z':
+        return _stack_matrix((cos, -sin, zero, sin, cos, zero, zero, zero, one))
+    raise Exception('Unknown axis: {}'.format(axis))
+
+
+def euler_to_matrix(euler, order='xyz'):
+    """ euler: (..., 3) in radians -> (..., 3, 3) = R_order[0] @ R_order[1] @ R_order[2] """
+    if order != 'xyz':
+        return torch.matmul(axis_to_matrix(euler[..., 0], order[0]),
+                            torch.matmul(axis_to_matrix(euler[..., 1], order[1]), axis_to_matrix(euler[..., 2], order[2])))
+    cos, sin = torch.cos(euler), torch.sin(euler)
+    ca, cb, cc = cos.unbind(-1)
+    sa, sb, sc = sin.unbind(-1)
+    return _stack_matrix((cb * cc, -cb * sc, sb,
+                          ca * sc + sa * sb * cc, ca * cc - sa * sb * sc, -sa * cb,
+                          sa * sc - ca * sb * cc, sa * cc + ca * sb * sc, ca * cb))
+
+
+def quaternion_to_matrix(quater):
+    """ quater: (..., 4) unit (w, x, y, z) -> (..., 3, 3), same as ForwardKinematics.transform_from_quaternion """
+    qw, qx, qy, qz = quater.unbind(-1)
+    x2, y2, z2 = qx + qx, qy + qy, qz + qz
+    xx, yy, zz = qx * x2, qy * y2, qz * z2
+    xy, yz, xz = qx * y2, qy * z2, qx * z2
+    wx, wy, wz = qw * x2, qw * y2, qw * z2
+    return _stack_matrix((1.0 - (yy + zz), xy - wz, xz + wy,
+                          xy + wz, 1.0 - (xx + zz), yz - wx,
+                          xz - wy, yz + wx, 1.0 - (xx + yy)))
+
+
+def axis_angle_to_quaternion(axis_angle, eps=1e-6):
+    """ axis_angle: (..., 3), direction is the axis and norm the angle in radians -> (..., 4); finite gradients at 0 """
+    angle_sq = (axis_angle * axis_angle).sum(dim=-1, keepdim=True)
+    small = angle_sq < eps
+    angle = torch.sqrt(torch.where(small, torch.ones_like(angle_sq), angle_sq))
+    # sin(angle / 2) / angle and cos(angle / 2), taylor expansion near 0
+    sin_ratio = torch.where(small, 0.5 - angle_sq / 48, torch.sin(angle / 2) / angle)
+    cos_half = torch.where(small, 1 - angle_sq / 8, torch.cos(angle / 2))
+    return torch.cat((cos_half, axis_angle * sin_ratio), dim=-1)
+
+
+def axis_angle_to_matrix(axis_angle):
+    """ axis_angle: (..., 3) -> (..., 3, 3) """
+    return quaternion_to_matrix(axis_angle_to_quaternion(axis_angle))
+
+
+def rotation_6d_to_matrix(d6, eps=1e-8):
+    """ d6: (..., 6), the first two rows of the matrix (Zhou et al. 2019), orthonormalized with Gram-Schmidt -> (..., 3, 3) """
+    a1, a2 = d6[..., :3], d6[..., 3:]
+    b1 = a1 / a1.norm(dim=-1, keepdim=True).clamp_min(eps)
+    b2 = a2 - (b1 * a2).sum(dim=-1, keepdim=True) * b1
+    b2 = b2 / b2.norm(dim=-1, keepdim=True).clamp_min(eps)
+    b3 = torch.cross(b1, b2, dim=-1)
+    return torch.stack((b1, b2, b3), dim=-2)
+
+
+def matrix_to_rotation_6d(matrix):
+    """ (..., 3, 3) -> (..., 6) """
+    return matrix[..., :2, :].reshape(matrix.shape[:-2] + (6,))
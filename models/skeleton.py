@@ -31,22 +31,11 @@ class SkeletonConv(nn.Module):
         self.padding_mode = padding_mode
         self._padding_repeated_twice = (padding, padding)
 
-        for neighbour in neighbour_list:
-            expanded = []
-            for k in neighbour:
-                for i in range(self.in_channels_per_joint):
-                    expanded.append(k * self.in_channels_per_joint + i)
-            self.expanded_neighbour_list.append(expanded)
+        self.expanded_neighbour_list = expand_neighbour_list(neighbour_list, self.in_channels_per_joint)
 
         if self.add_offset:
             self.offset_enc = SkeletonLinear(neighbour_list, in_offset_channel * len(neighbour_list), out_channels)
-
-            for neighbour in neighbour_list:
-                expanded = []
-                for k in neighbour:
-                    for i in range(add_offset):
-                        expanded.append(k * in_offset_channel + i)
-                self.expanded_neighbour_list_offset.append(expanded)
+            self.expanded_neighbour_list_offset = expand_neighbour_list(neighbour_list, in_offset_channel, add_offset)
 
         self.weight = torch.zeros(out_channels, in_channels, kernel_size)
         if bias:
@@ -54,9 +43,9 @@ class SkeletonConv(nn.Module):
         else:
             self.register_parameter('bias', None)
 
-        self.mask = torch.zeros_like(self.weight)
-        for i, neighbour in enumerate(self.expanded_neighbour_list):
-            self.mask[self.out_channels_per_joint * i: self.out_channels_per_joint * (i + 1), neighbour, ...] = 1
+        self.mask = neighbour_mask(neighbour_list, out_channels, in_channels,
+                                   self.out_channels_per_joint, self.in_channels_per_joint)
+        self.mask = self.mask.unsqueeze(-1).repeat(1, 1, kernel_size)
         self.mask = nn.Parameter(self.mask, requires_grad=False)
 
         self.description = 'SkeletonConv(in_channels_per_armature={}, out_channels_per_armature={}, kernel_size={}, ' \
@@ -114,17 +103,11 @@ class SkeletonLinear(nn.Module):
         self.in_channels_per_joint = in_channels // len(neighbour_list)
         self.out_channels_per_joint = out_channels // len(neighbour_list)
         self.extra_dim1 = extra_dim1
-        self.expanded_neighbour_list = []
-
-        for neighbour in neighbour_list:
-            expanded = []
-            for k in neighbour:
-                for i in range(self.in_channels_per_joint):
-                    expanded.append(k * self.in_channels_per_joint + i)
-            self.expanded_neighbour_list.append(expanded)
+        self.expanded_neighbour_list = expand_neighbour_list(neighbour_list, self.in_channels_per_joint)
 
         self.weight = torch.zeros(out_channels, in_channels)
-        self.mask = torch.zeros(out_channels, in_channels)
+        self.mask = neighbour_mask(neighbour_list, out_channels, in_channels,
+                                   self.out_channels_per_joint, self.in_channels_per_joint)
         self.bias = nn.Parameter(torch.Tensor(out_channels))
 
         self.reset_parameters()
@@ -134,7 +117,6 @@ class SkeletonLinear(nn.Module):
             tmp = torch.zeros_like(
                 self.weight[i*self.out_channels_per_joint: (i + 1)*self.out_channels_per_joint, neighbour]
             )
-            self.mask[i*self.out_channels_per_joint: (i + 1)*self.out_channels_per_joint, neighbour] = 1
             nn.init.kaiming_uniform_(tmp, a=math.sqrt(5))
             self.weight[i*self.out_channels_per_joint: (i + 1)*self.out_channels_per_joint, neighbour] = tmp
 
@@ -166,12 +148,9 @@ class SkeletonPool(nn.Module):
         self.seq_list = []
         self.pooling_list = []
         self.new_edges = []
-        degree = [0] * 100
+        topology = get_skeleton_topology(edges)
+        degree = topology.degree
 
-        for edge in edges:
-            degree[edge[0]] += 1
-            degree[edge[1]] += 1
-        
         def find_seq(j_indx, seq):
             nonlocal self, degree, edges
 
@@ -185,9 +164,8 @@ class SkeletonPool(nn.Module):
                 self.seq_list.append(seq)
                 return 
 
-            for idx, edge in enumerate(edges): # enumerate는 이미 거친건 확인하지 않는가?
-                if edge[0] == j_indx: # 모든 edge 중에(edge) j_indx와 같은 것을 찾음. 그것의 child로 다음 차례로 전달해줌. 
-                    find_seq(edge[1], seq + [idx])
+            for idx in topology.edge_children[j_indx]: # j_indx에서 시작하는 edge들(edge 순서). 그것의 child로 다음 차례로 전달해줌.
+                find_seq(edges[idx][1], seq + [idx])
 
         find_seq(0, [])
         # print("seq_list:{}".format(self.seq_list))
@@ -260,6 +238,89 @@ class SkeletonUnpool(nn.Module):
 Helper functions for skeleton operation
 """
 
+
+class SkeletonTopology:
+    """
+    Derived tables of one edge topology ((parent, child) of every edge), computed once with array ops
+    and shared by every consumer through get_skeleton_topology.
+        edge_mat      : (E, E) distance between edges, 1 on the diagonal like the original Floyd-Warshall
+        edge_children : edges starting at each joint, in edge order
+        degree        : number of edges at each joint
+        joint_order   : (edge index, parent joint) in the depth-first order of build_joint_topology
+    """
+    def __init__(self, pairs):
+        self.pairs = np.array(pairs, dtype=np.int64).reshape(-1, 2)
+        edge_num = len(self.pairs)
+        joint_num = int(self.pairs.max()) + 1 if edge_num > 0 else 1
+
+        # direct neighbours share a joint (every edge is its own neighbour: distance 1), then all-pairs shortest paths
+        edge_mat = np.full((edge_num, edge_num), 100000, dtype=np.int64)
+        link = (self.pairs[:, None, :, None] == self.pairs[None, :, None, :]).any(axis=(2, 3))
+        edge_mat[link] = 1
+        for k in range(edge_num):
+            np.minimum(edge_mat, edge_mat[:, k, None] + edge_mat[None, k, :], out=edge_mat)
+        self.edge_mat = edge_mat
+
+        self.degree = np.bincount(self.pairs.ravel(), minlength=joint_num)
+        self.edge_children = [[] for _ in range(joint_num)]
+        for idx, (pa, _) in enumerate(self.pairs):
+            self.edge_children[pa].append(idx)
+
+        # iterative version of the make_topology recursion
+        self.joint_order = []
+        stack = [(idx, 0) for idx in reversed(self.edge_children[0])]
+        while stack:
+            edge_idx, pa = stack.pop()
+            joint = len(self.joint_order) + 1
+            self.joint_order.append((edge_idx, pa))
+            child = self.pairs[edge_idx][1]
+            stack.extend((idx, joint) for idx in reversed(self.edge_children[child]))
+
+        self._neighbor_lists = {}
+
+    def neighbor_list(self, d):
+        """ edges within distance d of each edge (without the global part), a new list every call """
+        if d not in self._neighbor_lists:
+            rows, cols = np.nonzero(self.edge_mat <= d)
+            self._neighbor_lists[d] = np.split(cols, np.cumsum(np.bincount(rows, minlength=len(self.pairs)))[:-1])
+        return [neighbor.tolist() for neighbor in self._neighbor_lists[d]]
+
+
+_skeleton_topologies = {}
+
+
+def expand_neighbour_list(neighbour_list, channels_per_joint, channels_used=None):
+    """ channel indices of the neighbours of each joint: joint k -> k * channels_per_joint + [0, channels_used) """
+    if channels_used is None:
+        channels_used = channels_per_joint
+    channels = np.arange(channels_used)
+    return [(np.asarray(neighbour, dtype=np.int64)[:, None] * channels_per_joint + channels).ravel().tolist()
+            for neighbour in neighbour_list]
+
+
+def neighbour_mask(neighbour_list, out_channels, in_channels, out_channels_per_joint, in_channels_per_joint):
+    """ (out_channels, in_channels) 0/1 mask, block (i, k) is 1 when joint k is a neighbour of joint i """
+    joint_num = len(neighbour_list)
+    rows = np.repeat(np.arange(joint_num), [len(neighbour) for neighbour in neighbour_list])
+    cols = np.array([k for neighbour in neighbour_list for k in neighbour], dtype=np.int64)
+    adjacency = np.zeros((joint_num, max(joint_num, cols.max(initial=-1) + 1)), dtype=np.float32)
+    adjacency[rows, cols] = 1
+    blocks = np.kron(adjacency, np.ones((out_channels_per_joint, in_channels_per_joint), dtype=np.float32))
+
+    mask = np.zeros((out_channels, in_channels), dtype=np.float32)
+    blocks = blocks[:out_channels, :in_channels]
+    mask[:blocks.shape[0], :blocks.shape[1]] = blocks
+    return torch.from_numpy(mask)
+
+
+def get_skeleton_topology(edges):
+    """ SkeletonTopology of edges [(parent, child, ...), ...], cached by the (parent, child) pairs """
+    key = tuple((int(edge[0]), int(edge[1])) for edge in edges)
+    if key not in _skeleton_topologies:
+        _skeleton_topologies[key] = SkeletonTopology(key)
+    return _skeleton_topologies[key]
+
+
 def dfs(x, fa, vis, dist):
     vis[x] = 1
     for y in range(len(fa)):
@@ -307,82 +368,32 @@ def build_joint_topology(edges, origin_names):
     offset = []
     names = []
     edge2joint = []
-    # joint_from_edge = []  # -1 means virtual joint
-    joint_cnt = 0
-    out_degree = [0] * (len(edges) + 10)
-    for edge in edges:
-        out_degree[edge[0]] += 1
 
     """ add root joint"""
-    # joint_from_edge.append(-1)
     parent.append(0)
     offset.append(np.array([0, 0, 0]))
     names.append(origin_names[0])
-    joint_cnt += 1
 
-    def make_topology(edge_idx, pa): # child, parent
-        nonlocal edges, parent, offset, names, edge2joint, joint_cnt # joint_from_edge, 
+    # depth first from the edges of the root, children in edge order
+    for edge_idx, pa in get_skeleton_topology(edges).joint_order:
         edge = edges[edge_idx]
-
         parent.append(pa)
         offset.append(edge[2])
         names.append(origin_names[edge[1]])
         edge2joint.append(edge_idx)
-        pa = joint_cnt
-        joint_cnt += 1
-
-        for idx, e in enumerate(edges): # 모든 edges을 돌면서 
-            if e[0] == edge[1]: # (child의 parent idx = 현재 edge의 idx) 일 경우를 찾음 
-                make_topology(idx, pa)
-
-    # root와 연결되어있는 edge 에 대해서 
-    for idx, e in enumerate(edges):        
-        if e[0] == 0:
-            make_topology(idx, 0)
 
     return parent, offset, names, edge2joint
 
 
 def calc_edge_mat(edges):
-    edge_num = len(edges)
     # edge_mat[i][j] = distance between edge(i) and edge(j)
-    edge_mat = [[100000] * edge_num for _ in range(edge_num)]
-    for i in range(edge_num):
-        edge_mat[i][i] = 0
-
-    # initialize edge_mat with direct neighbor
-    for i, a in enumerate(edges):
-        for j, b in enumerate(edges):
-            link = 0
-            for x in range(2):
-                for y in range(2):
-                    if a[x] == b[y]:
-                        link = 1
-            if link:
-                edge_mat[i][j] = 1
-
-    # calculate all the pairs distance
-    for k in range(edge_num):
-        for i in range(edge_num):
-            for j in range(edge_num):
-                edge_mat[i][j] = min(edge_mat[i][j], edge_mat[i][k] + edge_mat[k][j])
-    return edge_mat
+    return get_skeleton_topology(edges).edge_mat.tolist()
 
 
 def find_neighbor(edges, d):    
-    edge_mat = calc_edge_mat(edges)
-    neighbor_list = []
-    edge_num = len(edge_mat)
-    # print("edges: {}".format(edges))
-    # print("edge_num: {}".format(edge_num))
+    neighbor_list = get_skeleton_topology(edges).neighbor_list(d)
+    edge_num = len(neighbor_list)
 
-    for i in range(edge_num):
-        neighbor = []
-        for j in range(edge_num):
-            if edge_mat[i][j] <= d:
-                neighbor.append(j)
-        neighbor_list.append(neighbor)
-        
     # add neighbor for global part
     global_part_neighbor = neighbor_list[0].copy()
     """
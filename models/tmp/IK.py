@@ -1,7 +1,8 @@
 import sys
+import numpy as np
 import torch
 from models.Kinematics import InverseKinematics
-from datasets.bvh_parser import BVH_file
+from datasets.skeleton_registry import get_skeleton
 from tqdm import tqdm
 
 sys.path.append('../utils')
@@ -23,8 +24,15 @@ def lerp(a, l, r):
 
 
 def get_character_height(file_name):
-    file = BVH_file(file_name)
-    return file.get_height()
+    return get_skeleton(file_path=file_name).get_height()
+
+
+def get_foot_contact_batch(glb, ee_ids, ref_height, threshold=0.003):
+    """ glb: (clip, T, J, 3) global positions -> contact: (clip, T, n_ee) int, the first frame is never a contact """
+    ee_pos = glb[:, :, ee_ids, :]
+    ee_velo = (ee_pos[:, 1:, ...] - ee_pos[:, :-1, ...]) / ref_height
+    contact = (torch.norm(ee_velo, dim=-1) < threshold).int()
+    return torch.cat([torch.zeros_like(contact[:, :1]), contact], dim=1)
 
 
 def get_foot_contact(file_name, ref_height):
@@ -32,17 +40,8 @@ def get_foot_contact(file_name, ref_height):
 
     ee_ids = get_ee_id_by_names(names)
 
-    glb = Animation.positions_global(anim)  # [T, J, 3]
-
-    ee_pos = glb[:, ee_ids, :]
-    ee_velo = ee_pos[1:, ...] - ee_pos[:-1, ...]
-    ee_velo = torch.tensor(ee_velo) / ref_height
-    ee_velo_norm = torch.norm(ee_velo, dim=-1)
-    contact = ee_velo_norm < 0.003
-    contact = contact.int()
-    padding = torch.zeros_like(contact)
-    contact = torch.cat([padding[:1, :], contact], dim=0)
-    return contact.numpy()
+    glb = torch.tensor(Animation.positions_global(anim))  # [T, J, 3]
+    return get_foot_contact_batch(glb[None], ee_ids, ref_height)[0].numpy()
 
 
 def get_ee_id_by_names(joint_names):
@@ -53,96 +52,135 @@ def get_ee_id_by_names(joint_names):
     return ee_id
 
 
-def fix_foot_contact(input_file, foot_file, output_file, ref_height):
-    anim, name, ftime = BVH.load(input_file)
-
-    fid = get_ee_id_by_names(name)
-    contact = get_foot_contact(foot_file, ref_height)
-
-    glb = Animation.positions_global(anim)  # [T, J, 3]
-
-    T = glb.shape[0]
-
-    for i, fidx in enumerate(fid):  # fidx: index of the foot joint
-        fixed = contact[:, i]  # [T]
-        s = 0
-        while s < T:
-            while s < T and fixed[s] == 0:
-                s += 1
-            if s >= T:
-                break
-            t = s
-            avg = glb[t, fidx].copy()
-            while t + 1 < T and fixed[t + 1] == 1:
-                t += 1
-                avg += glb[t, fidx].copy()
-            avg /= (t - s + 1)
-
-            for j in range(s, t + 1):
-                glb[j, fidx] = avg.copy()
-            s = t + 1
-
-        for s in range(T):
-            if fixed[s] == 1:
-                continue
-            l, r = None, None
-            consl, consr = False, False
-            for k in range(L):
-                if s - k - 1 < 0:
-                    break
-                if fixed[s - k - 1]:
-                    l = s - k - 1
-                    consl = True
-                    break
-            for k in range(L):
-                if s + k + 1 >= T:
-                    break
-                if fixed[s + k + 1]:
-                    r = s + k + 1
-                    consr = True
-                    break
-            if not consl and not consr:
-                continue
-            if consl and consr:
-                litp = lerp(alpha(1.0 * (s - l + 1) / (L + 1)),
-                            glb[s, fidx], glb[l, fidx])
-                ritp = lerp(alpha(1.0 * (r - s + 1) / (L + 1)),
-                            glb[s, fidx], glb[r, fidx])
-                itp = lerp(alpha(1.0 * (s - l + 1) / (r - l + 1)),
-                           ritp, litp)
-                glb[s, fidx] = itp.copy()
-                continue
-            if consl:
-                litp = lerp(alpha(1.0 * (s - l + 1) / (L + 1)),
-                            glb[s, fidx], glb[l, fidx])
-                glb[s, fidx] = litp.copy()
-                continue
-            if consr:
-                ritp = lerp(alpha(1.0 * (r - s + 1) / (L + 1)),
-                            glb[s, fidx], glb[r, fidx])
-                glb[s, fidx] = ritp.copy()
-
-    # glb is ready
-
-    anim = anim.copy()
-
-    rot = torch.tensor(anim.rotations.qs, dtype=torch.float)
-    pos = torch.tensor(anim.positions[:, 0, :], dtype=torch.float)
-    offset = torch.tensor(anim.offsets, dtype=torch.float)
-
-    glb = torch.tensor(glb, dtype=torch.float)
-
-    ik_solver = InverseKinematics(rot, pos, offset, anim.parents, glb)
-
-    print('Fixing foot contact using IK...')
-    for i in tqdm(range(50)):
+def get_blend_weights(dtype):
+    """
+    lerp weights of the frames around contact runs, by distance d (1..L) to the nearest contact frame
+    side: (L + 1, ) alpha((d + 1) / (L + 1)), both: (L + 1, L + 1) alpha((dl + 1) / (dl + dr + 1)) between two runs
+    -> weights and one minus weights, computed in double and cast like python floats in lerp
+    """
+    d = np.arange(L + 1, dtype=np.float64)
+    side = alpha((d + 1) / (L + 1))
+    both = alpha((d[:, None] + 1) / (d[:, None] + d[None, :] + 1))
+    return [(weight.astype(dtype), (1 - weight).astype(dtype)) for weight in (side, both)]
+
+
+def get_contact_targets_batch(glb, contact, fid):
+    """
+    glb: (clip, T, J, 3) global positions, contact: (clip, T, n_foot), fid: joint index of each foot
+    -> copy of glb with every foot fixed to its average position on each contact run
+       and blended over the L frames around the runs
+    """
+    glb = glb.copy()
+    n_clip, T = contact.shape[:2]
+    # one series per clip and foot: (series, T)
+    fixed = contact.transpose(0, 2, 1).reshape(-1, T) == 1
+    pos = glb[:, :, fid, :].transpose(0, 2, 1, 3).reshape(-1, T, 3)
+
+    """ 1. contact runs: segment mean, accumulated in frame order like the loop """
+    start = fixed & ~np.pad(fixed[:, :-1], ((0, 0), (1, 0)))
+    run = np.cumsum(start.ravel()).reshape(fixed.shape) - 1
+    sums = np.zeros((int(start.sum()), 3), dtype=pos.dtype)
+    np.add.at(sums, run[fixed], pos[fixed])
+    counts = np.bincount(run[fixed], minlength=sums.shape[0]).astype(pos.dtype)
+    pos[fixed] = (sums / counts[:, None])[run[fixed]]
+
+    """ 2. transitions: nearest contact frame within L frames on each side """
+    frame = np.broadcast_to(np.arange(T), fixed.shape)
+    left = np.maximum.accumulate(np.where(fixed, frame, -T - L), axis=1)
+    left = np.pad(left[:, :-1], ((0, 0), (1, 0)), constant_values=-T - L)
+    right = np.minimum.accumulate(np.where(fixed, frame, 2 * T + L)[:, ::-1], axis=1)[:, ::-1]
+    right = np.pad(right[:, 1:], ((0, 0), (0, 1)), constant_values=2 * T + L)
+    dl, dr = frame - left, right - frame
+    consl, consr = ~fixed & (dl <= L), ~fixed & (dr <= L)
+
+    (side, side_1m), (both, both_1m) = get_blend_weights(pos.dtype)
+    dl, dr = np.minimum(dl, L), np.minimum(dr, L)
+    series = np.arange(fixed.shape[0])[:, None]
+    litp = side_1m[dl][..., None] * pos + side[dl][..., None] * pos[series, np.clip(left, 0, T - 1)]
+    ritp = side_1m[dr][..., None] * pos + side[dr][..., None] * pos[series, np.clip(right, 0, T - 1)]
+    itp = both_1m[dl, dr][..., None] * ritp + both[dl, dr][..., None] * litp
+
+    pos = np.where((consl & consr)[..., None], itp,
+                   np.where(consl[..., None], litp, np.where(consr[..., None], ritp, pos)))
+    glb[:, :, fid, :] = pos.reshape(n_clip, -1, T, 3).transpose(0, 2, 1, 3)
+    return glb
+
+
+def get_contact_targets(glb, contact, fid):
+    """ glb: (T, J, 3) global positions of one clip, contact: (T, n_foot) -> targets of get_contact_targets_batch """
+    return get_contact_targets_batch(glb[None], np.asarray(contact)[None], fid)[0]
+
+
+def solve_ik(ik_solver, max_iter=50, tol=1e-4, verbose=True):
+    """ Adam steps until max_iter, or until no clip lowers its loss by more than tol (relative) in one step -> number of steps """
+    prev_losses = None
+    for i in tqdm(range(max_iter), disable=not verbose):
         ik_solver.step()
+        losses = ik_solver.losses
+        if prev_losses is not None and bool((prev_losses - losses <= tol * prev_losses).all()):
+            break
+        prev_losses = losses
+    return i + 1
+
+
+def fix_foot_contact_batch(rotations, positions, offset, parents, fid, ref_height, contact=None, glb=None,
+                           max_iter=50, tol=1e-4, lr=1e-3, verbose=True):
+    """
+    foot contact cleanup of many clips of one skeleton at once
+    rotations: (clip, T, J, 4) quaternions, positions: (clip, T, 3) root positions, offset: (J, 3) or (clip, J, 3)
+    contact: (clip, T, n_foot), detected on the clips themselves by default (pass the contacts of the source motions instead)
+    glb: (clip, T, J, 3) global positions of the clips, computed with the IK forward kinematics by default
+    -> (rotations, root positions, contact, number of IK steps)
+    """
+    ik_solver = InverseKinematics(rotations.clone(), positions.clone(), offset, parents, None, lr)
+    if glb is None:
+        with torch.no_grad():
+            glb = ik_solver.forward(ik_solver.rotations, ik_solver.position, offset, order='', quater=True, world=True)
+    glb = torch.as_tensor(glb)
+    if contact is None:
+        contact = get_foot_contact_batch(glb, fid, ref_height)
+    contact = torch.as_tensor(contact)
+
+    targets = get_contact_targets_batch(glb.cpu().numpy(), contact.cpu().numpy(), fid)
+    ik_solver.constrains = torch.tensor(targets, dtype=torch.float, device=rotations.device)
+
+    n_step = solve_ik(ik_solver, max_iter, tol, verbose)
 
     rotations = ik_solver.rotations.detach()
     norm = torch.norm(rotations, dim=-1, keepdim=True)
-    rotations /= norm
+    rotations = rotations / norm
+    return rotations, ik_solver.position.detach(), contact, n_step
 
-    anim.rotations = Quaternions(rotations.numpy())
-    anim.positions[:, 0, :] = ik_solver.position.detach().numpy()
 
-    BVH.save(output_file, anim, name, ftime)
+def fix_foot_contact(input_file, foot_file, output_file, ref_height, **ik_options):
+    fix_foot_contact_files([input_file], [foot_file], [output_file], ref_height, **ik_options)
+
+
+def fix_foot_contact_files(input_files, foot_files, output_files, ref_height, **ik_options):
+    """ contacts of foot_files[i] applied to input_files[i]; clips with the same number of frames are solved together """
+    clips = [BVH.load(input_file) for input_file in input_files]
+    groups = {}
+    for i, (anim, _, _) in enumerate(clips):
+        groups.setdefault(anim.shape[0], []).append(i)
+
+    print('Fixing foot contact using IK...')
+    for index in groups.values():
+        anims = [clips[i][0] for i in index]
+        name = clips[index[0]][1]
+        fid = get_ee_id_by_names(name)
+
+        contact = np.stack([get_foot_contact(foot_files[i], ref_height) for i in index])
+        glb = np.stack([Animation.positions_global(anim) for anim in anims])  # [clip, T, J, 3]
+
+        rot = torch.tensor(np.stack([anim.rotations.qs for anim in anims]), dtype=torch.float)
+        pos = torch.tensor(np.stack([anim.positions[:, 0, :] for anim in anims]), dtype=torch.float)
+        offset = torch.tensor(np.stack([anim.offsets for anim in anims]), dtype=torch.float)
+
+        rotations, positions, _, _ = fix_foot_contact_batch(
+            rot, pos, offset, anims[0].parents, fid, ref_height, contact=contact, glb=glb, **ik_options)
+
+        for j, i in enumerate(index):
+            anim = anims[j].copy()
+            anim.rotations = Quaternions(rotations[j].numpy())
+            anim.positions[:, 0, :] = positions[j].numpy()
+            BVH.save(output_files[i], anim, clips[i][1], clips[i][2])
@@ -2,6 +2,7 @@
 
 from torch import optim
 from torch import nn
+import torch.nn.functional as F
 import torch
 import random
 from torch.optim import lr_scheduler
@@ -36,6 +37,88 @@ class GAN_loss(nn.Module):
         loss = self.loss(prediction, target_tensor)
         return loss
 
+    def per_sample(self, prediction, target_is_real):
+        """ loss of each sample (dim 0) in one reduction: same value as calling self on prediction[i] """
+        target_tensor = self.get_target_tensor(prediction, target_is_real)
+        if self.gan_mode == 'lsgan':
+            loss = F.mse_loss(prediction, target_tensor, reduction='none')
+        elif self.gan_mode == 'vanilla':
+            loss = F.binary_cross_entropy_with_logits(prediction, target_tensor, reduction='none')
+        else:
+            raise Exception('Unknown GAN mode')
+        return loss.reshape(loss.size(0), -1).mean(dim=1)
+
+
+def mse_per_sample(prediction, target):
+    """ (bs, ...) -> (bs, ): MSELoss of each sample """
+    loss = F.mse_loss(prediction, target, reduction='none')
+    return loss.reshape(loss.size(0), -1).mean(dim=1)
+
+
+def mse_per_channel(prediction, target, channel_dim=1):
+    """ (bs, ..., channel, ...) -> (bs, channel): MSELoss of each channel of each sample """
+    loss = F.mse_loss(prediction, target, reduction='none')
+    loss = loss.movedim(channel_dim, 1)
+    return loss.reshape(loss.size(0), loss.size(1), -1).mean(dim=2)
+
+
+class LossAggregator:
+    """
+    Running mean of per-sample losses.
+    Sums are kept on the device of the losses; the host is synced only in summary().
+    """
+    def __init__(self, names):
+        self.names = list(names)
+        self.sums = {}
+        self.counts = {}
+        self.last_summary = {name: float('nan') for name in self.names}
+
+    def add(self, name, losses):
+        losses = losses.detach().reshape(-1)
+        if name not in self.sums:
+            self.sums[name] = torch.zeros((), dtype=torch.float64, device=losses.device)
+            self.counts[name] = 0
+            if name not in self.names:
+                self.names.append(name)
+        self.sums[name] += losses.sum(dtype=torch.float64)
+        self.counts[name] += losses.numel()
+
+    def summary(self):
+        """ mean of every recorded loss (nan if nothing was recorded), single device -> host copy """
+        names = [name for name in self.names if name in self.sums]
+        if names:
+            sums = torch.stack([self.sums[name].to(self.sums[names[0]].device) for name in names]).cpu().tolist()
+            for name, value in zip(names, sums):
+                self.last_summary[name] = value / self.counts[name]
+        return dict(self.last_summary)
+
+    def mean(self, name):
+        return self.summary()[name]
+
+
+""" mixed precision """
+
+
+def get_amp_dtype(device):
+    # fp16 + GradScaler on gpu, bfloat16 (no scaling needed) on cpu
+    return torch.float16 if torch.device(device).type == 'cuda' else torch.bfloat16
+
+
+def amp_autocast(args, enabled=None):
+    """ autocast context for the forward pass and the losses (--amp) """
+    device = torch.device(args.cuda_device)
+    if enabled is None:
+        enabled = bool(args.amp)
+    return torch.autocast(device_type=device.type, dtype=get_amp_dtype(device), enabled=enabled)
+
+
+def make_grad_scaler(args):
+    """ loss scaling for fp16, a pass-through when amp is off or on cpu """
+    enabled = bool(args.amp) and torch.device(args.cuda_device).type == 'cuda'
+    if hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler('cuda', enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
 
 # class Criterion_EE:
 #     def __init__(self, args, base_criterion, norm_eps=0.008):
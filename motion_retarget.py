@@ -8,31 +8,13 @@ from model import MotionGenerator
 from model import Discriminator
 from datasets.bvh_parser import BVH_file
 from datasets.bvh_writer import BVH_writer
+from datasets.bvh_export import BVHExporter
+from datasets.combined_motion import DeviceBatchLoader
+from datasets.skeleton_registry import get_skeleton, get_bvh_writer
 import wandb
 from train import *
 from test import *
 
-""" motion data collate function """
-
-
-def motion_collate_fn(inputs):
-    # Data foramt: (4,96,1,69,32) (캐릭터수, , 1, 조인트, 윈도우)
-    enc_input_motions, dec_input_motions, gt_motions = list(zip(*inputs))
-
-    enc_input = torch.nn.utils.rnn.pad_sequence(
-        enc_input_motions, batch_first=True, padding_value=0)
-    dec_input = torch.nn.utils.rnn.pad_sequence(
-        dec_input_motions, batch_first=True, padding_value=0)
-    gt = torch.nn.utils.rnn.pad_sequence(
-        gt_motions, batch_first=True, padding_value=0)
-
-    batch = [
-        enc_input,
-        dec_input,
-        gt
-    ]
-    return batch
-
 def save(model, path, epoch):
     try_mkdir(path)
     path = os.path.join(path, str(epoch))
@@ -70,6 +52,11 @@ def load(model, optimizer, path, name, epoch):
 """ Set Env Parameters """
 args = option_parser.get_args()
 # args = args_
+
+""" Background BVH export """
+# the export workers are forked here, before CUDA and wandb start their threads
+exporter = BVHExporter(args.export_workers, args.export_max_pending)
+
 args.cuda_device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
 # args.model_save_dir = "models"
 log_path = os.path.join(args.save_dir, 'logs/')
@@ -81,9 +68,20 @@ print("cuda availiable: {}".format(torch.cuda.is_available()))
 """ load Motion Dataset """
 characters = get_character_names(args)
 dataset = create_dataset(args, characters)
-loader = torch.utils.data.DataLoader(
-    dataset, batch_size=args.batch_size, shuffle=False, collate_fn=motion_collate_fn)
-offsets = dataset.get_offsets()
+if args.device_dataset:
+    # small corpora: windows are gathered, shuffled and reversed on the gpu
+    loader = DeviceBatchLoader(dataset.to(args.cuda_device), args.batch_size, shuffle=bool(args.shuffle))
+else:
+    loader_options = {'num_workers': args.num_workers,
+                      'pin_memory': bool(args.pin_memory) and torch.cuda.is_available()}
+    if args.num_workers > 0:
+        loader_options['prefetch_factor'] = args.prefetch_factor
+        loader_options['persistent_workers'] = bool(args.persistent_workers)
+    # every batch is a contiguous slice of one character's windows, fetched at once without collate copies
+    loader = torch.utils.data.DataLoader(
+        dataset, sampler=dataset.get_batch_sampler(args.batch_size, shuffle=bool(args.shuffle)),
+        batch_size=None, **loader_options)
+offsets = dataset.get_offsets(args.cuda_device)
 print("characters:{}".format(characters))
 
 """ load model  """
@@ -101,9 +99,8 @@ for i in range(len(characters)):
     bvh_writers = []
     files = []
     for j in range(len(characters[0])):
-        file = BVH_file(option_parser.get_std_bvh(dataset=characters[i][j]))
-        files.append(file)
-        bvh_writers.append(BVH_writer(file.edges, file.names))
+        files.append(get_skeleton(characters[i][j]))
+        bvh_writers.append(get_bvh_writer(characters[i][j]))
 
     Files.append(files)
     BVHWriters.append(bvh_writers)
@@ -117,13 +114,23 @@ if args.epoch_begin:
 optimizerG = torch.optim.Adam(generatorModel.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay)
 optimizerD = torch.optim.Adam(discriminatorModel.parameters(), lr=args.learning_rate, weight_decay=args.weight_decay)
 
+""" Mixed precision """
+if args.amp and args.amp_check and args.is_train == 1:
+    enc_inputs, gt_motions = map(lambda v: v.to(args.cuda_device), next(iter(loader))[:2])
+    passed, _ = amp_parity_check(args, generatorModel, discriminatorModel, enc_inputs, gt_motions)
+    if not passed:
+        print('amp disabled: the error against fp32 is above --amp_tolerance {}'.format(args.amp_tolerance))
+        args.amp = 0
+    del enc_inputs, gt_motions
+scaler = make_grad_scaler(args)
+
 if args.is_train == 1:
     # for every epoch
     for epoch in range(args.epoch_begin, args.n_epoch):
         loss, fk_loss, G_loss, D_loss_real, D_loss_fake = train_epoch(
             args, epoch, generatorModel, discriminatorModel, optimizerG, optimizerD,
             loader, dataset,
-            characters, save_name, Files)
+            characters, save_name, Files, exporter, scaler)
 
         wandb.log({"loss": loss},               step=epoch)
         wandb.log({"fk_loss": fk_loss},         step=epoch)
@@ -144,4 +151,6 @@ else:
     eval_epoch(
         args, model,
         dataset, loader,
-        characters, save_name, Files)
+        characters, save_name, Files, exporter)
+
+exporter.close()
@@ -10,6 +10,11 @@ def get_parser():
     parser.add_argument('--is_train', type=int, default=1)
     parser.add_argument('--is_valid', type=int, default=0)
     parser.add_argument('--render', type=int, default=0)
+    parser.add_argument('--log_interval', type=int, default=10, help='steps between host syncs of the running losses shown by tqdm')
+    parser.add_argument('--export_workers', type=int, default=2, help='processes writing bvh files in background, 0: write in the training loop')
+    parser.add_argument('--export_max_pending', type=int, default=8, help='max number of batches waiting to be written')
+    parser.add_argument('--preprocess_workers', type=int, default=4, help='processes parsing bvh files in preprocess.py')
+    parser.add_argument('--preprocess_force', type=int, default=0, help='1: ignore the preprocess manifest and rebuild every character')
 
     # Dataset representation
     parser.add_argument('--rotation', type=str, default='quaternion', help='representatio0 of rotation:xyz, quaternion')
@@ -17,6 +22,7 @@ def get_parser():
     # num motions for_character. dummy value 1
     parser.add_argument('--num_motions', type=int, default=1)
     parser.add_argument('--batch_size', type=int,default=64, help='batch_size')  # 16
+    parser.add_argument('--micro_batch_size', type=int, default=0, help='gradient accumulation: run each batch in micro-batches of this size, 0: whole batch at once')
     parser.add_argument('--input_size', type=int, default=0, help='')
     parser.add_argument('--output_size', type=int, default=0, help='')
     parser.add_argument('--n_enc_seq', type=int, default=0, help='')
@@ -30,6 +36,14 @@ def get_parser():
     parser.add_argument('--data_encoding', type=int, default=1, help='positional encoding')
     parser.add_argument('--data_augment', type=int, default=0, help='data_augment: 1 or 0')
 
+    # Data loading
+    parser.add_argument('--num_workers', type=int, default=0, help='DataLoader worker processes, 0: load in the training process')
+    parser.add_argument('--pin_memory', type=int, default=1, help='pin batches in page-locked memory for async copies to the gpu')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='batches loaded in advance by each worker')
+    parser.add_argument('--persistent_workers', type=int, default=1, help='keep workers alive between epochs')
+    parser.add_argument('--shuffle', type=int, default=0, help='shuffle windows inside each character')
+    parser.add_argument('--device_dataset', type=int, default=0, help='1: upload the dataset to the gpu once and build batches there')
+
     # Network
     parser.add_argument('--layer_norm_epsilon', type=float, default=1e-12)
     parser.add_argument('--i_pad', type=int, default=0)
@@ -41,7 +55,11 @@ def get_parser():
     # xyz embedding dimenstion: 69 -> (64) -> 32
     # quaternion embedding dimenstion: 91 -> 91 -> 111
     parser.add_argument('--embedding_dim', type=int, default=256,help='embedding dimension')  # window을 얼마나 줄일지에 대한 embedding
+    parser.add_argument('--attention_backend', type=str, default='fused', help='fused: torch scaled_dot_product_attention when attention maps are not needed, explicit: always softmax(QK^T)V')
+    parser.add_argument('--fk_backend', type=str, default='levels', help='loop: one joint at a time, levels: one batched matmul per skeleton depth, script / compile: levels with torch.jit.script / torch.compile')
     parser.add_argument('--gan_mode', type=str, default='lsgan')
+    parser.add_argument('--gan_update', type=str, default='shared', help='shared: one discriminator pass per step for the D and G losses, alternating: D step, then G step against the updated D')
+    parser.add_argument('--light_discriminator', type=int, default=0, help='1: encoder-only discriminator with a linear head')
 
     # loss flag
     parser.add_argument('--rec_loss', type=int, default=1, help='1. rec loss')
@@ -63,6 +81,9 @@ def get_parser():
     parser.add_argument('--activation', type=str, default='LeakyReLU', help='activation: ReLU, LeakyReLU, tanh')
     parser.add_argument('--n_epoch', type=int, default=10001)
     parser.add_argument('--epoch_begin', type=int, default=0)
+    parser.add_argument('--amp', type=int, default=0, help='mixed precision: fp16 autocast + GradScaler on gpu, bfloat16 autocast on cpu')
+    parser.add_argument('--amp_check', type=int, default=1, help='compare amp against fp32 on the first batch before training')
+    parser.add_argument('--amp_tolerance', type=float, default=2e-2, help='max relative error of the amp parity check')
     # parser.add_argument('--upsampling', type=str, default='linear', help="'stride2' or 'nearest', 'linear'")
     # parser.add_argument('--downsampling', type=str, default='stride2', help='stride2 or max_pooling')
     # parser.add_argument('--batch_normalization', type=int, default=0, help='batch_norm: 1 or 0')
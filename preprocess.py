@@ -1,31 +1,77 @@
 import os
+import json
 import numpy as np
 import copy
+from concurrent.futures import ProcessPoolExecutor
 from datasets.bvh_parser import BVH_file
-from datasets.motion_dataset import MotionData
+from datasets.motion_dataset import get_window_tensor
+from datasets.motion_statistics import RunningStatistics
+from datasets.motion_store import write_motion_store, get_store_paths
+from datasets.skeleton_registry import CACHE_VERSION, file_hash, get_cache_path, check_cache_version, remove_stale_cache
 # from option_parser import get_args, try_mkdir
 from option_parser import *
 import option_parser
 
-def collect_bvh(args, data_path, character, files):
-    print('begin {}'.format(character))
-    motions = []
-    
-    for i, motion in enumerate(files):
-        if args.is_train == 1:
-            path = data_path + character + '/' + motion
-        elif args.is_train == 0:
-            path = data_path + character + '/test/' + motion
-        else:
-            print("error")
+def get_bvh_path(args, data_path, character, motion):
+    if args.is_train == 1:
+        return data_path + character + '/' + motion
+    elif args.is_train == 0:
+        return data_path + character + '/test/' + motion
+    else:
+        print("error")
+
+def load_bvh(path):
+    file = BVH_file(path)
+    return file.to_tensor().permute((1, 0)).numpy()
 
-        if not os.path.exists(path):
-            print("no data")
-            continue
-        file = BVH_file(path)
-        new_motion = file.to_tensor().permute((1, 0)).numpy()
-        motions.append(new_motion)
+def get_config(args):
+    """ options the saved arrays and statistics depend on """
+    return {'rotation': args.rotation, 'window_size': args.window_size, 'root_pos_disp': args.root_pos_disp,
+            'swap_dim': args.swap_dim, 'normalization': args.normalization}
 
+def process_bvh(args, path, digest):
+    """
+    worker: parse one bvh and compute the mean/var statistics of its windows
+    the parsed motion and statistics are cached next to the bvh, keyed by its content hash,
+    one entry per clip: the entries of older contents are deleted when a new one is written
+    """
+    config = json.dumps(get_config(args), sort_keys=True)
+    cache_path = get_cache_path(path, digest, 'clips')
+    motion = None
+    if os.path.exists(cache_path):
+        try:
+            with np.load(cache_path, allow_pickle=False) as cache:
+                check_cache_version(cache)
+                motion = cache['motion']
+                if str(cache['config']) == config:
+                    return motion, RunningStatistics.from_state_dict(cache)
+        except (OSError, KeyError, ValueError):
+            motion = None
+
+    # statistics are recomputed from the cached motion when only the options changed
+    if motion is None:
+        motion = load_bvh(path)
+    statistics = clip_statistics(args, motion)
+
+    try:
+        os.makedirs(os.path.dirname(cache_path), exist_ok=True)
+        tmp_path = cache_path + '.tmp.npz'
+        np.savez(tmp_path, version=np.array(CACHE_VERSION), motion=motion, config=np.array(config),
+                 **statistics.state_dict())
+        os.replace(tmp_path, cache_path)
+        remove_stale_cache(path, cache_path)
+    except OSError:
+        pass
+    return motion, statistics
+
+def clip_statistics(args, motion):
+    # statistics over (windows, frames) for each channel, same reduction as MotionData
+    windows = get_window_tensor(motion, args)
+    if windows is None:
+        return RunningStatistics()
+    return RunningStatistics.from_data(windows.numpy(), axis=(0, 2))
+
+def save_motions(args, data_path, character, motions):
     if args.is_train == 1:
         save_file = data_path + character + '.npy'
     elif args.is_train == 0:
@@ -33,8 +79,8 @@ def collect_bvh(args, data_path, character, files):
     else:
         print("error")
 
-    np.save(save_file, motions)
-    print('Npy file saved at {}'.format(save_file))
+    write_motion_store(save_file, motions)
+    print('Motion store saved at {}'.format(', '.join(get_store_paths(save_file))))
 
 def copy_std_bvh(args, data_path, character, files):
     """
@@ -48,19 +94,16 @@ def copy_std_bvh(args, data_path, character, files):
         print("error")
     os.system(cmd)
 
-# mean / var 저장
-def write_statistics(args, character, path):
-    # args = option_parser.get_args()
-    # new_args = copy.copy(args)
-    args.data_augment = 0
-    args.dataset = character
-
-    dataset = MotionData(args, 1)
-
-    mean = dataset.mean
-    var = dataset.var
-    mean = mean.cpu().numpy()[0, ...]
-    var = var.cpu().numpy()[0, ...]
+def save_statistics(args, character, path, statistics):
+    if args.normalization and statistics.count > 0:
+        mean = statistics.mean[0, ...].astype(np.float32)
+        var = statistics.std[0, ...].astype(np.float32)
+    else:
+        mean = np.zeros(statistics.mean.shape[1:], dtype=np.float32) if statistics.count > 0 else None
+        var = np.ones_like(mean) if mean is not None else None
+    if mean is None:
+        print("no window for {}".format(character))
+        return
 
     if args.is_train == 1:
         np.save(path + '{}_mean.npy'.format(character), mean)
@@ -68,9 +111,83 @@ def write_statistics(args, character, path):
     elif args.is_train == 0:
         np.save(path + '{}_mean_test.npy'.format(character), mean)
         np.save(path + '{}_var_test.npy'.format(character), var)
-    else: 
+    else:
         print("error")
 
+def get_output_paths(args, data_path, character):
+    suffix = '' if args.is_train == 1 else '_test'
+    return [*get_store_paths(data_path + character + suffix + '.npy'),
+            './datasets/Mixamo/std_bvhs/{}.bvh'.format(character),
+            './datasets/Mixamo/mean_var/{}_mean{}.npy'.format(character, suffix),
+            './datasets/Mixamo/mean_var/{}_var{}.npy'.format(character, suffix)]
+
+""" manifest: content hash of every source bvh of the last run, per character """
+
+def get_manifest_path(args, data_path):
+    suffix = '' if args.is_train == 1 else '_test'
+    return data_path + 'preprocess_manifest{}.json'.format(suffix)
+
+def load_manifest(path):
+    if not os.path.exists(path):
+        return {'config': None, 'characters': {}}
+    with open(path, 'r') as f:
+        return json.load(f)
+
+def save_manifest(path, manifest):
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=1, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def is_up_to_date(args, data_path, character, entry, hashes):
+    if entry is None or entry['files'] != hashes:
+        return False
+    return all(os.path.exists(p) for p in get_output_paths(args, data_path, character))
+
+def preprocess_parallel(args, prefix, characters, character_files):
+    """
+    parse every bvh of every character in a process pool, statistics are merged from per-clip results
+    characters whose bvh files did not change since the last run are skipped,
+    unchanged clips of the other characters are read from the per-clip cache
+    """
+    args.data_augment = 0
+    manifest_path = get_manifest_path(args, prefix)
+    manifest = load_manifest(manifest_path)
+    config = get_config(args)
+    if args.preprocess_force or manifest['config'] != config:
+        manifest = {'config': config, 'characters': {}}
+
+    hashes = {}
+    for character in characters:
+        hashes[character] = {motion: file_hash(get_bvh_path(args, prefix, character, motion))
+                             for motion in character_files[character]}
+    updates = [c for c in characters
+               if not is_up_to_date(args, prefix, c, manifest['characters'].get(c), hashes[c])]
+    for character in characters:
+        if character not in updates:
+            print('skip {}: up to date'.format(character))
+
+    with ProcessPoolExecutor(max_workers=args.preprocess_workers) as pool:
+        # fan out all (character, file) pairs at once
+        jobs = {}
+        for character in updates:
+            jobs[character] = [pool.submit(process_bvh, args, get_bvh_path(args, prefix, character, motion),
+                                           hashes[character][motion])
+                               for motion in character_files[character]]
+
+        for character in updates:
+            print('begin {}'.format(character))
+            results = [job.result() for job in jobs[character]]
+            motions = [motion for motion, _ in results]
+            statistics = RunningStatistics.merge_all([s for _, s in results])
+
+            save_motions(args, prefix, character, motions)
+            copy_std_bvh(args, prefix, character, character_files[character])
+            save_statistics(args, character, './datasets/Mixamo/mean_var/', statistics)
+
+            manifest['characters'][character] = {'files': hashes[character]}
+            save_manifest(manifest_path, manifest)
+
 
 if __name__ == '__main__':
     args = option_parser.get_args()
@@ -83,6 +200,7 @@ if __name__ == '__main__':
     try_mkdir(os.path.join(prefix, 'std_bvhs'))
     try_mkdir(os.path.join(prefix, 'mean_var'))
 
+    character_files = {}
     for character in characters:
         if args.is_train == 1:
             data_path = os.path.join(prefix, character)
@@ -91,8 +209,6 @@ if __name__ == '__main__':
         else:
             print("Error")
 
-        files = sorted([f for f in os.listdir(data_path) if f.endswith(".bvh")])
-        collect_bvh(args, prefix, character, files)
-        copy_std_bvh(args, prefix, character, files)
-        write_statistics(args, character, './datasets/Mixamo/mean_var/')
-   
\ No newline at end of file
+        character_files[character] = sorted([f for f in os.listdir(data_path) if f.endswith(".bvh")])
+
+    preprocess_parallel(args, prefix, characters, character_files)
@@ -13,7 +13,7 @@ from tqdm import tqdm
 from datasets.bvh_parser import BVH_file
 
 sys.path.append("/utils")
-import BVH_mod as BVH
+import BVH_fast as BVH
 
 
 def split_joint(file_name, save_file=None):
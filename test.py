@@ -9,6 +9,7 @@ from tqdm import tqdm
 from datasets.bvh_parser import BVH_file
 from datasets.bvh_writer import BVH_writer
 from models.Kinematics import ForwardKinematics
+from models.utils import LossAggregator, mse_per_channel, amp_autocast
 from rendering import *
 from train import *
 
@@ -19,16 +20,18 @@ os.makedirs(SAVE_ATTENTION_DIR, exist_ok=True)
 """ eval """
 
 
-def eval_epoch(args, model, test_dataset, data_loader, characters, save_name, Files):
+def eval_epoch(args, model, test_dataset, data_loader, characters, save_name, Files, exporter=None):
     model.eval()
-    losses = []  # losses for test epoch # 매 스텝마다 초기화 되는 loss들
-    fk_losses = []
+    # per-channel losses for test epoch, kept on device
+    losses = LossAggregator(['loss', 'fk_loss'])
     # fk_loss_by_motions = []
     with tqdm(total=len(data_loader), desc=f"TestSet") as pbar:
         for i, value in enumerate(data_loader):
 
-            enc_inputs, dec_inputs, gt_motions = map(
-                lambda v: v.to(args.cuda_device), value)
+            enc_inputs, gt_motions = map(
+                lambda v: v.to(args.cuda_device, non_blocking=True), value[:2])
+            motion_ids = value[2]
+            dec_inputs = gt_motions
             # enc_inputs, dec_inputs = enc_motions, input_motion
 
             # """ Get Data numbers: (bs, DoF, window) """
@@ -39,13 +42,14 @@ def eval_epoch(args, model, test_dataset, data_loader, characters, save_name, Fi
             else:
                 num_DoF, num_frame = Dim1, Dim2
 
-            motion_idx = get_curr_motion(i, args.batch_size)
-            character_idx = get_curr_character(motion_idx, args.num_motions)
+            character_idx, _ = get_batch_position(i, args.batch_size, args.num_motions)
             file = Files[1][character_idx]
 
             """ feed to network """
-            output_motions, enc_self_attn_probs, dec_self_attn_probs, dec_enc_attn_probs = model(
-                character_idx, character_idx, enc_inputs, dec_inputs)
+            with amp_autocast(args):
+                output_motions, enc_self_attn_probs, dec_self_attn_probs, dec_enc_attn_probs = model(
+                    character_idx, character_idx, enc_inputs, dec_inputs, return_attention=True)
+            output_motions = output_motions.float()
 
             """ save attention map """
             bs = enc_self_attn_probs[0].size(0)
@@ -96,27 +100,23 @@ def eval_epoch(args, model, test_dataset, data_loader, characters, save_name, Fi
             loss_sum = 0
 
             # """ 5-1. loss on each element """
-            for m in range(num_bs):
-                for j in range(num_DoF):
-                    loss = criterion(gt_motions[m][j], output_motions[m][j])
-                    loss_sum += loss
-                    losses.append(loss.item())
+            # gt_motions: (bs, frame, DoF) here (swap_dim was undone above) -> loss: (bs, DoF)
+            loss = mse_per_channel(output_motions, gt_motions, channel_dim=2)
+            loss_sum += loss.sum()
+            losses.add('loss', loss)
 
             """ 2. fk loss """
             if args.fk_loss == 1:
                 fk = ForwardKinematics(args, file.edges)
                 gt_transform = fk.forward_from_raw(denorm_gt_motions.permute(
-                    0, 2, 1), test_dataset.offsets[1][character_idx]).reshape(num_bs, -1, num_frame)
+                    0, 2, 1), test_dataset.offsets[1][character_idx].to(args.cuda_device)).reshape(num_bs, -1, num_frame)
                 output_transform = fk.forward_from_raw(denorm_output_motions.permute(
-                    0, 2, 1), test_dataset.offsets[1][character_idx]).reshape(num_bs, -1, num_frame)
+                    0, 2, 1), test_dataset.offsets[1][character_idx].to(args.cuda_device)).reshape(num_bs, -1, num_frame)
 
-                num_DoF = gt_motions.size(1)
-                for m in range(num_bs):
-                    for j in range(num_DoF):  # check dimension
-                        loss = criterion(
-                            gt_transform[m][j], output_transform[m][j])
-                        loss_sum += loss
-                        fk_losses.append(loss.item())
+                # (bs, joint * 3, frame) -> loss: (bs, joint * 3)
+                fk_loss = mse_per_channel(output_transform, gt_transform, channel_dim=1)
+                loss_sum += fk_loss.sum()
+                losses.add('fk_loss', fk_loss)
 
                 """ Rendering FK result """
                 # 16,69,128 -> 16,128,69
@@ -128,29 +128,24 @@ def eval_epoch(args, model, test_dataset, data_loader, characters, save_name, Fi
                     # divide 69 -> 23,3
                     render_dots(gt_transform[0][0].reshape(-1, 3))
 
-                for m in range(num_bs):
-                    for j in range(num_DoF):
-                        loss = criterion(
-                            gt_transform[m][j], output_transform[m][j])
-                        fk_losses.append(loss.item())
-
             """ show info """
             pbar.update(1)
-            pbar.set_postfix_str(f"denorm_loss: (mean: {np.mean(losses):.3f})")
+            if i % args.log_interval == 0 or i == len(data_loader) - 1:
+                pbar.set_postfix_str(f"denorm_loss: (mean: {losses.mean('loss'):.3f})")
             # pbar.set_postfix_str(f"denorm_loss: {np.mean(fk_losses):.3f}, (mean: {np.mean(losses):.3f})")
 
             """ BVH Writing """
             save_dir = args.save_dir + save_name
             write_bvh(save_dir, "0_test_gt", denorm_gt_motions,
-                      characters, character_idx, motion_idx, args)
+                      characters, character_idx, motion_ids, args, exporter)
             write_bvh(save_dir, "0_test_output", denorm_output_motions,
-                      characters, character_idx, motion_idx, args)
+                      characters, character_idx, motion_ids, args, exporter)
 
         # del
         torch.cuda.empty_cache()
         del enc_inputs, dec_inputs
 
-    print("retargeting loss: {}".format(np.mean(losses)))
+    print("retargeting loss: {}".format(losses.mean('loss')))
     # return np.sum(matchs) / len(matchs) if 0 < len(matchs) else 0
 
 
@@ -1,16 +1,20 @@
+import math
+import contextlib
 import torch
 import os
 import numpy as np
 from wandb import set_trace
 from datasets import get_character_names
+from datasets.displacement import decode_root_displacement
 import option_parser
 from tqdm import tqdm
 from datasets.bvh_parser import BVH_file
 from datasets.bvh_writer import BVH_writer
+from datasets.bvh_export import write_motions
 from models.Kinematics import ForwardKinematics
 from rendering import *
 import torchvision
-from models.utils import GAN_loss
+from models.utils import GAN_loss, LossAggregator, mse_per_sample, amp_autocast, make_grad_scaler
 import wandb
 
 SAVE_ATTENTION_DIR = "attention_vis_intra"
@@ -19,60 +23,185 @@ os.makedirs(SAVE_ATTENTION_DIR, exist_ok=True)
 # def get_data_numbers(motion):
 #     return motion.size(0), motion.size(1), motion.size(2)
 
-def get_curr_motion(iter, batch_size):
-    return iter * batch_size
-
-def get_curr_character(motion_idx, num_motions):
-    return int(motion_idx / num_motions)
+def get_batch_position(iter, batch_size, num_motions):
+    """
+    (character index, index of the first motion in the character) of the iter-th batch:
+    batches never cross characters, the last batch of a character is shorter when batch_size does not divide num_motions
+    """
+    batches_per_character = math.ceil(num_motions / batch_size)
+    character_idx, batch_idx = divmod(iter, batches_per_character)
+    return character_idx, batch_idx * batch_size
 
 def denormalize(dataset, character_idx, motions):
     return dataset.denorm(1, character_idx, motions)
 
 def remake_root_position_from_displacement(args, motions, num_bs, num_frame, num_DoF):
-    for bs in range(num_bs):  # dim 0
-        for frame in range(num_frame - 1):  # dim 2 # frame: 0~62. update 1 ~ 63
-            motions[bs][frame + 1][num_DoF -
-                                   3] += motions[bs][frame][num_DoF - 3]
-            motions[bs][frame + 1][num_DoF -
-                                   2] += motions[bs][frame][num_DoF - 2]
-            motions[bs][frame + 1][num_DoF -
-                                   1] += motions[bs][frame][num_DoF - 1]
-
-    return motions
-
-def write_bvh(save_dir, gt_or_output_epoch, motion, characters, character_idx, motion_idx, args):
+    # motions: (bs, frame, DoF)
+    return decode_root_displacement(motions, swap_dim=0)
+
+def write_bvh(save_dir, gt_or_output_epoch, motion, characters, character_idx, motion_ids, args, exporter=None):
+    """ motion_ids: index of each window inside the character (the loader yields them, batches can be shuffled) """
     save_dir_gt = save_dir + "character{}_{}/{}/".format(
         character_idx, characters[1][character_idx], gt_or_output_epoch)
     try_mkdir(save_dir_gt)
-    file = BVH_file(option_parser.get_std_bvh(
-        dataset=characters[1][character_idx]))
-    bvh_writer = BVH_writer(file.edges, file.names)
-    for j in range(args.batch_size):
-        file_name = save_dir_gt + \
-            "motion_{}.bvh".format(int(motion_idx % args.num_motions + j))
-        bvh_writer.write_raw(motion[j], args.rotation, file_name)
+    file_names = [save_dir_gt + "motion_{}.bvh".format(int(motion_id)) for motion_id in motion_ids.reshape(-1).tolist()]
+    if exporter is None:
+        write_motions(characters[1][character_idx], motion.detach().cpu().numpy(), args.rotation, file_names)
+    else:
+        exporter.submit(characters[1][character_idx], motion, args.rotation, file_names)
 
 def try_mkdir(path):
     if not os.path.exists(path):
         # print('make new dir')
         os.system('mkdir -p {}'.format(path))
 
-def train_epoch(args, epoch, modelG, modelD, optimizerG, optimizerD, train_loader, train_dataset, characters, save_name, Files):
-    losses = []  # losses for 1 epoch (for all motion, all batch_size)
-    fk_losses = []
-    reg_losses = []
-    rec_losses = []
-    G_losses = []
-    D_losses = []
-    D_losses_fake = []
-    D_losses_real = []
+def relative_error(reference, value):
+    return ((value.float() - reference.float()).norm() / reference.float().norm().clamp_min(1e-12)).item()
+
+def amp_parity_check(args, modelG, modelD, enc_inputs, gt_motions, character_idx=0):
+    """
+    run one fixed batch in fp32 and with autocast (--amp), return (passed, relative errors)
+    of the generator output and the rec / GAN losses
+    """
+    gan_criterion = GAN_loss(args.gan_mode).to(args.cuda_device)
+    training = modelG.training, modelD.training
+    modelG.eval()
+    modelD.eval()
+
+    results = []
+    with torch.no_grad():
+        for enabled in (False, True):
+            with amp_autocast(args, enabled):
+                output_motions = modelG(character_idx, character_idx, enc_inputs, gt_motions)[0]
+                fake_output = modelD(character_idx, character_idx, output_motions, output_motions)
+            output_motions = output_motions.float()
+            rec_loss = mse_per_sample(output_motions, gt_motions).mean()
+            G_loss = gan_criterion.per_sample(fake_output.float(), True).mean()
+            results.append((output_motions, rec_loss, G_loss))
+
+    modelG.train(training[0])
+    modelD.train(training[1])
+
+    errors = {name: relative_error(reference, value)
+              for name, reference, value in zip(['output', 'rec_loss', 'G_loss'], results[0], results[1])}
+    passed = all(error <= args.amp_tolerance for error in errors.values())
+    print('amp parity check ({}): {}'.format('passed' if passed else 'failed',
+          ', '.join('{} {:.2e}'.format(name, error) for name, error in errors.items())))
+    return passed, errors
+
+def trainable_parameters(model):
+    return [p for p in model.parameters() if p.requires_grad]
+
+@contextlib.contextmanager
+def frozen(params):
+    """ requires_grad off for params inside the block, restored on exit (also on errors) """
+    for p in params:
+        p.requires_grad_(False)
+    try:
+        yield
+    finally:
+        for p in params:
+            p.requires_grad_(True)
+
+def discriminate(args, modelD, character_idx, real_motions, fake_motions):
+    """ one discriminator pass on the real and fake batches stacked together -> (real_output, fake_output) """
+    motions = torch.cat([real_motions, fake_motions])
+    with amp_autocast(args):
+        output = modelD(character_idx, character_idx, motions, motions)
+    return output.float().split([real_motions.size(0), fake_motions.size(0)])
+
+def discriminator_backward(args, modelD, scaler, gan_criterion, character_idx, real_motions, fake_motions, losses):
+    """ D losses of one micro-batch, backward into the discriminator parameters only -> fake_output """
+    real_output, fake_output = discriminate(args, modelD, character_idx, real_motions, fake_motions)
+    D_loss_real = gan_criterion.per_sample(real_output, True)
+    D_loss_fake = gan_criterion.per_sample(fake_output, False)
+    losses.add('D_loss_real', D_loss_real)
+    losses.add('D_loss_fake', D_loss_fake)
+    # fakes still attached to the generator: keep the graph for the generator loss
+    scaler.scale(D_loss_real.sum() + D_loss_fake.sum()).backward(
+        inputs=trainable_parameters(modelD), retain_graph=fake_motions.requires_grad)
+    return fake_output
+
+def train_step(args, modelG, modelD, optimizerG, optimizerD, scaler, gan_criterion,
+               character_idx, enc_inputs, gt_motions, losses):
+    """
+    forward, backward and optimizer steps of one batch of one character -> generator output (detached)
+    The batch runs in micro-batches of --micro_batch_size whose gradients are accumulated before the optimizer steps.
+    Every loss is summed over samples, so the accumulated gradients are those of the whole batch.
+    --gan_update shared: a single discriminator pass on [real; fake] gives the D and G losses,
+        each backward only reaches the parameters of its own model (G and D both step against the same D)
+    --gan_update alternating: D steps on [real; fake.detach()] first, then G against the updated and frozen D
+        (the fakes of the D phase come from an extra no_grad generator pass)
+    """
+    optimizerG.zero_grad()
+    optimizerD.zero_grad()
+
+    size = args.micro_batch_size if args.micro_batch_size > 0 else enc_inputs.size(0)
+    micro_batches = list(zip(enc_inputs.split(size), gt_motions.split(size)))
+    gan = args.gan_loss == 1
+    shared = args.gan_update == 'shared'
+    D_params = trainable_parameters(modelD)
+
+    """ D phase (alternating) """
+    if gan and not shared:
+        for enc, gt in micro_batches:
+            with torch.no_grad(), amp_autocast(args):
+                fake_motions = modelG(character_idx, character_idx, enc, gt)[0]
+            discriminator_backward(args, modelD, scaler, gan_criterion, character_idx, enc, fake_motions.float(), losses)
+        scaler.step(optimizerD)
+
+    """ G phase: against a frozen D (alternating) """
+    outputs = []
+    with frozen(D_params) if gan and not shared else contextlib.nullcontext():
+        for enc, gt in micro_batches:
+            # decoder input is the gt target motion
+            with amp_autocast(args):
+                output_motions = modelG(character_idx, character_idx, enc, gt)[0]
+            # losses in fp32
+            output_motions = output_motions.float()
+
+            """ loss1. loss on each element """
+            sum_loss = 0
+            if args.rec_loss == 1:
+                rec_loss = mse_per_sample(output_motions, gt)
+                sum_loss += rec_loss.sum()
+                losses.add('rec_loss', rec_loss)
+
+            """ loss2. GAN Loss """
+            # discriminator : (fake output: 0), (real_data: 1)
+            if gan:
+                if shared:
+                    fake_output = discriminator_backward(
+                        args, modelD, scaler, gan_criterion, character_idx, enc, output_motions, losses)
+                else:
+                    with amp_autocast(args):
+                        fake_output = modelD(character_idx, character_idx, output_motions, output_motions).float()
+                G_loss = gan_criterion.per_sample(fake_output, True)
+                sum_loss = sum_loss + G_loss.sum()
+                losses.add('G_loss', G_loss)
+
+            scaler.scale(sum_loss).backward(inputs=trainable_parameters(modelG))
+            outputs.append(output_motions.detach())
+
+        """ optimize """
+        scaler.step(optimizerG)
+    if gan and shared:
+        scaler.step(optimizerD)
+    scaler.update()
+    return torch.cat(outputs)
+
+def train_epoch(args, epoch, modelG, modelD, optimizerG, optimizerD, train_loader, train_dataset, characters, save_name, Files, exporter=None, scaler=None):
+    # per-sample losses for 1 epoch (for all motion, all batch_size), kept on device
+    losses = LossAggregator(['rec_loss', 'fk_loss', 'G_loss', 'D_loss_real', 'D_loss_fake'])
+    # loss scaling for fp16 (--amp), pass-through otherwise
+    if scaler is None:
+        scaler = make_grad_scaler(args)
 
     modelG.train()
     modelD.train()
 
     args.epoch = epoch
     character_idx = 0
-    rec_criterion = torch.nn.MSELoss()
     gan_criterion = GAN_loss(args.gan_mode).to(args.cuda_device)
 
     with tqdm(total=len(train_loader), desc=f"TrainEpoch {epoch}") as pbar:
@@ -80,12 +209,11 @@ def train_epoch(args, epoch, modelG, modelD, optimizerG, optimizerD, train_loade
         try_mkdir(save_dir)
 
         for i, value in enumerate(train_loader):
-            optimizerG.zero_grad()
-            # optimizerD.zero_grad()
-
             """ Get Data and Set value to model and Get output """
-            enc_inputs, dec_inputs, gt_motions = map(
-                lambda v: v.to(args.cuda_device), value)
+            enc_inputs, gt_motions = map(
+                lambda v: v.to(args.cuda_device, non_blocking=True), value[:2])
+            motion_ids = value[2]
+            dec_inputs = gt_motions
 
             # """ Get Data numbers: (bs, DoF, window) """
             num_bs, Dim1, Dim2 = gt_motions.size(0), gt_motions.size(1), gt_motions.size(2)
@@ -94,15 +222,13 @@ def train_epoch(args, epoch, modelG, modelD, optimizerG, optimizerD, train_loade
             else:
                 num_DoF, num_frame = Dim1, Dim2
 
-            motion_idx = get_curr_motion(i, args.batch_size)
-            character_idx = get_curr_character(motion_idx, args.num_motions)
+            character_idx, _ = get_batch_position(i, args.batch_size, args.num_motions)
             file = Files[1][character_idx]
             # height = file.get_height()
 
-            """ feed to NETWORK """
-            output_motions, enc_self_attn_probs, dec_self_attn_probs, dec_enc_attn_probs = modelG(
-                character_idx, character_idx, enc_inputs, dec_inputs)
-
+            """ feed to NETWORK, get LOSS (rec & GAN), backward and optimize """
+            output_motions = train_step(args, modelG, modelD, optimizerG, optimizerD, scaler, gan_criterion,
+                                        character_idx, enc_inputs, dec_inputs, losses)
 
             """ Data post-processing """
             """ 1) denorm for bvh_writing """
@@ -154,19 +280,7 @@ def train_epoch(args, epoch, modelG, modelD, optimizerG, optimizerD, train_loade
             #         torchvision.utils.save_image(
             #             att_map, f"./{SAVE_ATTENTION_DIR}/enc_dec_{att_layer_index}_{epoch:04d}.jpg", range=(0, 1), normalize=True)
 
-            """ Get LOSS (orienation & FK & regularization) """
-
-            """ loss1. loss on each element """
-            sum_loss = 0
-            if args.rec_loss == 1:
-                # rec_loss = 0
-                for idx_batch in range(num_bs):
-                    rec_loss = rec_criterion(gt_motions[idx_batch], output_motions[idx_batch])
-                    # rec_loss += loss
-                    sum_loss += rec_loss
-                    rec_losses.append(rec_loss.item())
-                # rec_loss.backward() # retain_graph=True
-                # optimizerG.step()
+            """ Get LOSS (orienation & FK & regularization): rec and GAN loss in train_step """
 
             """ loss 1-2. fk loss """
             # if args.fk_loss == 1:
@@ -190,41 +304,6 @@ def train_epoch(args, epoch, modelG, modelD, optimizerG, optimizerD, train_loade
                 # render_dots(gt_global_pos[0][0].reshape(-1,3)) # divide 69 -> 23,3
                 # render_dots_and_lines(gt_global_pos[0][0].reshape(-1,3), file.topology) # divide 69 -> 23,3
 
-            """ loss2. GAN Loss"""
-            # discriminator : (fake output: 0), (real_data: 1)
-            if args.gan_loss == 1:
-                """ Discriminator """
-                # real 
-                # D_loss_real = 0
-                real_output = modelD(character_idx, character_idx, enc_inputs, enc_inputs)
-                for idx_batch in range(num_bs):
-                    D_loss_real = gan_criterion(real_output[idx_batch], True)
-                    sum_loss += D_loss_real
-                    D_losses_real.append(D_loss_real.item())
-                # D_loss_real.backward()
-
-                # fake
-                fake_output = modelD(character_idx, character_idx, output_motions.detach(), output_motions.detach())
-                for idx_batch in range(num_bs):
-                    D_loss_fake = gan_criterion(fake_output[idx_batch], False)
-                    sum_loss += D_loss_fake
-                    D_losses_fake.append(D_loss_fake.item())
-                # D_loss_fake.backward()
-
-                # optimize Discriminator  
-                # optimizerD.step()
-
-                """ Generator """
-                fake_output = modelD(character_idx, character_idx, output_motions, output_motions)
-                for idx_batch in range(num_bs):
-                    G_loss = gan_criterion(fake_output[idx_batch], True)
-                    sum_loss += G_loss
-                    G_losses.append(G_loss.item())
-                # G_loss.backward()
-
-            #     # optimize Generator
-            #     optimizerG.step()
-
             """ 5. atten score loss """
             # if args.reg_loss == 1:
             #     n_layer = len(enc_self_attn_probs)
@@ -254,31 +333,26 @@ def train_epoch(args, epoch, modelG, modelD, optimizerG, optimizerD, train_loade
             # loss = rec_criterion(gt_motions, output_motions)
             # losses.append(loss.item())
 
-            """ backward and optimize """
-            sum_loss.backward() # retain_graph=True
-            optimizerG.step()
-            optimizerD.step()
-            # G_loss.backward()
-            # D_loss_real.backward()
-            # D_loss_fake.backward()
-
             """  and show info """
             pbar.update(1)
-            pbar.set_postfix_str(
-                f"mean: {np.mean(rec_losses):.3f}, fk_loss: {np.mean(fk_losses):.3f}, G_loss: {np.mean(G_losses):.3f}, D_loss_real: {np.mean(D_losses_real):.3f}, D_loss_fake: {np.mean(D_losses_fake):.3f}")
+            if i % args.log_interval == 0 or i == len(train_loader) - 1:
+                mean_losses = losses.summary()
+                pbar.set_postfix_str(
+                    f"mean: {mean_losses['rec_loss']:.3f}, fk_loss: {mean_losses['fk_loss']:.3f}, G_loss: {mean_losses['G_loss']:.3f}, D_loss_real: {mean_losses['D_loss_real']:.3f}, D_loss_fake: {mean_losses['D_loss_fake']:.3f}")
 
             # loss 확인할시 추가
 
             """ BVH Writing """
             if epoch == 0:
                 write_bvh(save_dir, "gt", denorm_gt_motions,
-                          characters, character_idx, motion_idx, args)
+                          characters, character_idx, motion_ids, args, exporter)
 
             if epoch % 10 == 0:
                 write_bvh(save_dir, "output_"+str(epoch), denorm_output_motions,
-                          characters, character_idx, motion_idx, args)
+                          characters, character_idx, motion_ids, args, exporter)
 
         torch.cuda.empty_cache()
         del gt_motions, enc_inputs, dec_inputs, output_motions
 
-    return np.mean(rec_losses), np.mean(fk_losses), np.mean(G_losses), np.mean(D_losses_real), np.mean(D_losses_fake)
+    mean_losses = losses.summary()
+    return mean_losses['rec_loss'], mean_losses['fk_loss'], mean_losses['G_loss'], mean_losses['D_loss_real'], mean_losses['D_loss_fake']
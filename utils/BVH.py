@@ -5,6 +5,7 @@ sys.path.append("motion_utils")
 
 from Animation import Animation
 from Quaternions_old import Quaternions
+import BVH_fast
 
 channelmap = {
     'Xrotation' : 'x',
@@ -55,117 +56,10 @@ def load(filename, start=None, end=None, order=None, world=False):
         Tuple of loaded animation and joint names
     """
     
-    f = open(filename, "r")
-
-    i = 0
-    active = -1
-    end_site = False
-    
-    names = []
-    orients = Quaternions.id(0)
-    offsets = np.array([]).reshape((0,3))
-    parents = np.array([], dtype=int)
-    
-    for line in f:
-        
-        if "HIERARCHY" in line: continue
-        if "MOTION" in line: continue
-
-        rmatch = re.match(r"ROOT (\w+)", line)
-        if rmatch:
-            names.append(rmatch.group(1))
-            offsets    = np.append(offsets,    np.array([[0,0,0]]),   axis=0)
-            orients.qs = np.append(orients.qs, np.array([[1,0,0,0]]), axis=0)
-            parents    = np.append(parents, active)
-            active = (len(parents)-1)
-            continue
-
-        if "{" in line: continue
-
-        if "}" in line:
-            if end_site: end_site = False
-            else: active = parents[active]
-            continue
-        
-        offmatch = re.match(r"\s*OFFSET\s+([\-\d\.e]+)\s+([\-\d\.e]+)\s+([\-\d\.e]+)", line)
-        if offmatch:
-            if not end_site:
-                offsets[active] = np.array([list(map(float, offmatch.groups()))])
-            continue
-           
-        chanmatch = re.match(r"\s*CHANNELS\s+(\d+)", line)
-        if chanmatch:
-            channels = int(chanmatch.group(1))
-            if order is None:
-                channelis = 0 if channels == 3 else 3
-                channelie = 3 if channels == 3 else 6
-                parts = line.split()[2+channelis:2+channelie]
-                if any([p not in channelmap for p in parts]):
-                    continue
-                order = "".join([channelmap[p] for p in parts])
-            continue
-
-        jmatch = re.match("\s*JOINT\s+(\w+)", line)
-        if jmatch:
-            names.append(jmatch.group(1))
-            offsets    = np.append(offsets,    np.array([[0,0,0]]),   axis=0)
-            orients.qs = np.append(orients.qs, np.array([[1,0,0,0]]), axis=0)
-            parents    = np.append(parents, active)
-            active = (len(parents)-1)
-            continue
-        
-        if "End Site" in line:
-            end_site = True
-            continue
-              
-        fmatch = re.match("\s*Frames:\s+(\d+)", line)
-        if fmatch:
-            if start and end:
-                fnum = (end - start)-1
-            else:
-                fnum = int(fmatch.group(1))
-            jnum = len(parents)
-            # result: [fnum, J, 3]
-            positions = offsets[np.newaxis].repeat(fnum, axis=0)
-            # result: [fnum, len(orients), 3]
-            rotations = np.zeros((fnum, len(orients), 3))
-            continue
-        
-        fmatch = re.match("\s*Frame Time:\s+([\d\.]+)", line)
-        if fmatch:
-            frametime = float(fmatch.group(1))
-            continue
-        
-        if (start and end) and (i < start or i >= end-1):
-            i += 1
-            continue
-        
-        dmatch = line.strip().split()
-        if dmatch:
-            data_block = np.array(list(map(float, dmatch)))
-            N = len(parents)
-            fi = i - start if start else i
-            if   channels == 3:
-                # This should be root positions[0:1] & all rotations
-                positions[fi,0:1] = data_block[0:3]
-                rotations[fi, : ] = data_block[3: ].reshape(N,3)
-            elif channels == 6:
-                data_block = data_block.reshape(N,6)
-                # fill in all positions
-                positions[fi,:] = data_block[:,0:3]
-                rotations[fi,:] = data_block[:,3:6]
-            elif channels == 9:
-                positions[fi,0] = data_block[0:3]
-                data_block = data_block[3:].reshape(N-1,9)
-                rotations[fi,1:] = data_block[:,3:6]
-                positions[fi,1:] += data_block[:,0:3] * data_block[:,6:9]
-            else:
-                raise Exception("Too many channels! %i" % channels)
-
-            i += 1
+    names, offsets, parents, positions, rotations, frametime, order = \
+        BVH_fast.load_raw(filename, start, end, order, name_pattern=r"\w+")
+    orients = Quaternions.id(len(parents))
 
-    f.close()
-    
     rotations = Quaternions.from_euler(np.radians(rotations), order=order, world=world)
     
     return (Animation(rotations, positions, orients, offsets, parents), names, frametime)
@@ -0,0 +1,172 @@
+import re
+import numpy as np
+
+from Animation import Animation
+from Quaternions import Quaternions
+
+channelmap = {
+    'Xrotation' : 'x',
+    'Yrotation' : 'y',
+    'Zrotation' : 'z'
+}
+
+""" Modified line read to handle mixamo data """
+NAME_PATTERN = r"\w+:?\w+"
+
+offset_re = re.compile(r"\s*OFFSET\s+([\-\d\.e]+)\s+([\-\d\.e]+)\s+([\-\d\.e]+)")
+channel_re = re.compile(r"\s*CHANNELS\s+(\d+)")
+frames_re = re.compile(r"\s*Frames:\s+(\d+)")
+frametime_re = re.compile(r"\s*Frame Time:\s+([\d\.]+)")
+
+
+def load_raw(filename, start=None, end=None, order=None, name_pattern=NAME_PATTERN):
+    """
+    Reads a BVH file into plain arrays.
+    The hierarchy is parsed line by line once, the whole MOTION block is read
+    with a single bulk numeric conversion into a (frames, channels) array.
+
+    Returns
+    -------
+
+    (names, offsets, parents, positions, rotations, frametime, order)
+        rotations are euler angles in degrees with shape [F, J, 3]
+    """
+
+    with open(filename, "r") as f:
+        text = f.read()
+
+    """ split HIERARCHY / MOTION header from the frame rows """
+    header_end = text.find("Frame Time")
+    if header_end < 0:
+        raise Exception('No frame time in %s' % filename)
+    header_end = text.find("\n", header_end)
+    if header_end < 0: header_end = len(text)
+    header = text[:header_end]
+    body = text[header_end + 1:]
+
+    root_re = re.compile(r"ROOT (%s)" % name_pattern)
+    joint_re = re.compile(r"\s*JOINT\s+(%s)" % name_pattern)
+
+    active = -1
+    end_site = False
+    channels = None
+    fnum = None
+    frametime = None
+
+    names = []
+    offsets = []
+    parents = []
+
+    for line in header.split("\n"):
+
+        if "HIERARCHY" in line: continue
+        if "MOTION" in line: continue
+
+        rmatch = root_re.match(line)
+        if rmatch:
+            names.append(rmatch.group(1))
+            offsets.append([0., 0., 0.])
+            parents.append(active)
+            active = len(parents) - 1
+            continue
+
+        if "{" in line: continue
+
+        if "}" in line:
+            if end_site: end_site = False
+            else: active = parents[active]
+            continue
+
+        offmatch = offset_re.match(line)
+        if offmatch:
+            if not end_site:
+                offsets[active] = list(map(float, offmatch.groups()))
+            continue
+
+        chanmatch = channel_re.match(line)
+        if chanmatch:
+            channels = int(chanmatch.group(1))
+            if order is None:
+                channelis = 0 if channels == 3 else 3
+                channelie = 3 if channels == 3 else 6
+                parts = line.split()[2+channelis:2+channelie]
+                if any([p not in channelmap for p in parts]):
+                    continue
+                order = "".join([channelmap[p] for p in parts])
+            continue
+
+        jmatch = joint_re.match(line)
+        if jmatch:
+            names.append(jmatch.group(1))
+            offsets.append([0., 0., 0.])
+            parents.append(active)
+            active = len(parents) - 1
+            continue
+
+        if "End Site" in line:
+            end_site = True
+            continue
+
+        fmatch = frames_re.match(line)
+        if fmatch:
+            fnum = int(fmatch.group(1))
+            continue
+
+        fmatch = frametime_re.match(line)
+        if fmatch:
+            frametime = float(fmatch.group(1))
+            continue
+
+    N = len(parents)
+    offsets = np.array(offsets, dtype=np.float64).reshape((N, 3))
+    parents = np.array(parents, dtype=int)
+
+    """ bulk read of all frame rows: (frames, channels) """
+    if   channels == 3: n_channel = 3 + N * 3
+    elif channels == 6: n_channel = N * 6
+    elif channels == 9: n_channel = 3 + (N - 1) * 9
+    else: raise Exception("Too many channels! %i" % channels)
+
+    data = np.fromstring(body, dtype=np.float64, sep=' ')
+    if data.size % n_channel != 0:
+        raise Exception('Unexpected number of values in the MOTION block of %s' % filename)
+    data = data.reshape((-1, n_channel))
+
+    if start and end:
+        fnum = (end - start) - 1
+        data = data[start:end-1]
+
+    positions = offsets[np.newaxis].repeat(fnum, axis=0)
+    rotations = np.zeros((fnum, N, 3))
+    F = data.shape[0]
+
+    if   channels == 3:
+        positions[:F, 0] = data[:, 0:3]
+        rotations[:F] = data[:, 3:].reshape(F, N, 3)
+    elif channels == 6:
+        data = data.reshape(F, N, 6)
+        positions[:F] = data[..., 0:3]
+        rotations[:F] = data[..., 3:6]
+    elif channels == 9:
+        positions[:F, 0] = data[:, 0:3]
+        data = data[:, 3:].reshape(F, N - 1, 9)
+        rotations[:F, 1:] = data[..., 3:6]
+        positions[:F, 1:] += data[..., 0:3] * data[..., 6:9]
+
+    return names, offsets, parents, positions, rotations, frametime, order
+
+
+def load(filename, start=None, end=None, order=None, world=False, need_quater=False):
+    """
+    Drop-in replacement of BVH_mod.load, returns an identical
+    (animation, joint_names, frametime)
+    """
+    names, offsets, parents, positions, rotations, frametime, order = load_raw(filename, start, end, order)
+    orients = Quaternions.id(len(parents))
+
+    if need_quater:
+        rotations = Quaternions.from_euler(np.radians(rotations), order=order, world=world)
+    elif order != 'xyz':
+        rotations = Quaternions.from_euler(np.radians(rotations), order=order, world=world)
+        rotations = np.degrees(rotations.euler())
+    return (Animation(rotations, positions, orients, offsets, parents), names, frametime)